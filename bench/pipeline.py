@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the uglyd pipeline end to end without touching the network. The
+feeds, the Google token endpoint and Gmail's IMAP server are replaced by the
+stand-ins in :mod:`ugly.stubs`, a fresh database is seeded with N users who
+are each subscribed to M of the feeds and then each round polls every feed
+(``update_feeds``) and delivers everything that's new (``send_emails``).
+The first round starts from an empty database and, before each of the
+following rounds, every feed publishes ``--new-entries`` new entries.
+
+For example::
+
+    python bench/pipeline.py --users 200 --subscriptions 20 --feeds 1000
+
+"""
+
+from __future__ import division, print_function
+
+import os
+import imp
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from sqlalchemy import event
+
+from ugly.stubs import FeedServer, IMAPServer, TokenServer
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self)
+
+    def __call__(self, *args):
+        with self.lock:
+            self.count += 1
+
+
+def seed(uglyd, feeds, args):
+    from ugly.database import db
+    from ugly.migrations import upgrade
+    from ugly.models import User, Feed, subscriptions
+
+    upgrade(uglyd.app)
+    db.session.execute(Feed.__table__.insert(), [
+        dict(url=feeds.feed_url(n), active=True) for n in range(args.feeds)])
+    users = [User("bench-{0}@example.com".format(i), "refresh-{0}".format(i))
+             for i in range(args.users)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    ids = [i for i, in db.session.query(Feed.id).order_by(Feed.id)]
+    rng = random.Random(args.seed)
+    db.session.execute(subscriptions.insert(), [
+        dict(user_id=user.id, feed_id=feed_id)
+        for user in users
+        for feed_id in rng.sample(ids, min(args.subscriptions, len(ids)))])
+    db.session.commit()
+
+
+def run_round(uglyd, feeds, imap, queries):
+    from ugly.database import db
+    from ugly.models import Feed, Entry
+
+    # Make every feed due.
+    db.session.query(Feed).update({Feed.next_check_at: None})
+    db.session.commit()
+
+    result = {}
+    entries = Entry.query.count()
+    requests = feeds.requests
+    queries.count = 0
+    strt = time.time()
+    outcomes = uglyd.update_feeds()
+    dt = time.time() - strt
+    new = Entry.query.count() - entries
+    result["update"] = dict(
+        seconds=dt, feeds=sum(outcomes.values()),
+        feeds_per_second=sum(outcomes.values()) / dt,
+        entries=new, entries_per_second=new / dt,
+        requests=feeds.requests - requests, queries=queries.count,
+        outcomes=dict(outcomes))
+
+    messages = imap.messages
+    queries.count = 0
+    strt = time.time()
+    delivered, users, failed = uglyd.send_emails()
+    dt = time.time() - strt
+    appended = imap.messages - messages
+    result["deliver"] = dict(
+        seconds=dt, messages=appended, messages_per_second=appended / dt,
+        users=users, failed=failed, queries=queries.count)
+    db.session.remove()
+    return result
+
+
+def report(results):
+    for i, r in enumerate(results):
+        u, d = r["update"], r["deliver"]
+        print("Round {0}".format(i + 1))
+        print("  update:  {0:7.2f} s  {1:8.1f} feeds/s  {2:8.1f} entries/s  "
+              "{3:6d} queries  ({4})".format(
+                  u["seconds"], u["feeds_per_second"],
+                  u["entries_per_second"], u["queries"],
+                  ", ".join("{0} {1}".format(v, k)
+                            for k, v in sorted(u["outcomes"].items()))))
+        print("  deliver: {0:7.2f} s  {1:8.1f} messages/s  "
+              "{2:6d} queries  ({3} users, {4} failed)".format(
+                  d["seconds"], d["messages_per_second"], d["queries"],
+                  d["users"], d["failed"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--subscriptions", type=int, default=20,
+                        help="subscriptions per user")
+    parser.add_argument("--feeds", type=int, default=500)
+    parser.add_argument("--entries", type=int, default=20,
+                        help="entries in each feed")
+    parser.add_argument("--new-entries", type=int, default=2,
+                        help="entries published before each later round")
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--etag", default="strong",
+                        choices=["strong", "changing", "none"])
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to each feed response")
+    parser.add_argument("--imap-latency", type=float, default=0,
+                        help="seconds added to each IMAP command")
+    parser.add_argument("--entry-size", type=int, default=500,
+                        help="bytes in each entry body")
+    parser.add_argument("--imap-capabilities",
+                        default="UIDPLUS,LITERAL+,MULTIAPPEND")
+    parser.add_argument("--delivery-workers", type=int, default=None)
+    parser.add_argument("--fetch-workers", type=int, default=None)
+    parser.add_argument("--worker-id", default=None,
+                        help="claim the feeds and users through leases "
+                        "like one of several uglyd workers")
+    parser.add_argument("--db", default=None,
+                        help="database URI (a temporary SQLite file by "
+                        "default); it must be empty")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", default=None,
+                        help="also write the results to this file")
+    parser.add_argument("--metrics-dir", default=None,
+                        help="write uglyd's metrics for all of the rounds "
+                        "to this directory")
+    parser.add_argument("--profile", default=None,
+                        help="profile the feed updates and deliveries into "
+                        "this directory")
+    parser.add_argument("--profile-threshold", type=float, default=1000,
+                        help="only keep the profiles of the units that take "
+                        "longer than this many milliseconds")
+    parser.add_argument("--profile-sql", action="store_true",
+                        help="record the SQL issued by the profiled units")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="ugly-bench-")
+    feeds = FeedServer(feeds=args.feeds, entries=args.entries,
+                       etag=args.etag, latency=args.latency,
+                       entry_size=args.entry_size).start()
+    caps = [c for c in args.imap_capabilities.split(",") if c]
+    imap = IMAPServer(capabilities=caps, latency=args.imap_latency).start()
+    tokens = TokenServer().start()
+    try:
+        # Point uglyd at the stand-ins.
+        config = dict(
+            SQLALCHEMY_DATABASE_URI=args.db or "sqlite:///" + os.path.join(
+                tmpdir, "bench.db"),
+            GOOGLE_TOKEN_URL=tokens.url,
+            IMAP_HOST=imap.host, IMAP_PORT=imap.port, IMAP_SSL=False,
+        )
+        if args.delivery_workers is not None:
+            config["DELIVERY_WORKERS"] = args.delivery_workers
+        if args.fetch_workers is not None:
+            config["FETCH_WORKERS"] = args.fetch_workers
+        if args.worker_id is not None:
+            config["WORKER_ID"] = args.worker_id
+        config_file = os.path.join(tmpdir, "config.py")
+        with open(config_file, "w") as f:
+            for k, v in config.items():
+                f.write("{0} = {1!r}\n".format(k, v))
+
+        sys.argv = ["uglyd", "--config", config_file]
+        uglyd = imp.load_source("uglyd", os.path.join(root, "uglyd"))
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.ERROR)
+
+        from ugly.database import db
+        queries = QueryCounter(db.get_engine(uglyd.app))
+
+        strt = time.time()
+        seed(uglyd, feeds, args)
+        print("Seeded {0} users x {1} subscriptions of {2} feeds in {3:.1f} s"
+              .format(args.users, args.subscriptions, args.feeds,
+                      time.time() - strt))
+
+        from ugly.metrics import metrics
+        metrics.reset()
+        if args.profile is not None:
+            from ugly.profiling import Profiler
+            uglyd.profiler = Profiler(
+                args.profile, threshold=args.profile_threshold,
+                engine=db.get_engine(uglyd.app) if args.profile_sql else None)
+        results = []
+        for i in range(args.rounds):
+            if i:
+                feeds.publish(args.new_entries)
+            results.append(run_round(uglyd, feeds, imap, queries))
+
+        # ru_maxrss is in kilobytes on Linux (and bytes on OS X).
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            rss /= 1024
+        report(results)
+        print("Peak RSS: {0:.1f} MB".format(rss / 1024))
+        print("Feed server: {0} requests, {1} not modified, {2:.1f} MB sent"
+              .format(feeds.requests, feeds.not_modified,
+                      feeds.bytes / 1024 / 1024))
+        print("IMAP server: {0} messages, {1} copies, {2} token requests"
+              .format(imap.messages, imap.copies, tokens.requests))
+
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(dict(args=vars(args), rounds=results,
+                               peak_rss_mb=rss / 1024,
+                               imap_commands=imap.commands), f, indent=2)
+        if args.metrics_dir is not None:
+            metrics.write(args.metrics_dir)
+        if uglyd.profiler is not None:
+            uglyd.profiler.write()
+
+        # Hang up the keep-alive connections before the servers go away.
+        from ugly.fetch import get_fetcher
+        with uglyd.app.test_request_context():
+            get_fetcher().session.close()
+    finally:
+        feeds.stop()
+        imap.stop()
+        tokens.stop()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
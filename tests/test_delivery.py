@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+import feedparser
+from email import message_from_string
+from email.header import decode_header
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+from ugly import create_app
+from ugly.database import db
+from ugly.migrations import upgrade, sync_tracking
+from ugly.models import User, Feed, Entry, outbox, subscriptions
+from ugly.stubs import IMAPServer, TokenServer
+
+
+def _rejected(msg):
+    subject = message_from_string(msg)["Subject"]
+    return any("bad" in s for s, charset in decode_header(subject))
+
+
+class DeliveryTest(unittest.TestCase):
+
+    titles = ["good 0", "good 1", "good 2", "good 3", "good 4"]
+
+    def setUp(self):
+        logging.disable(logging.ERROR)
+        self.tmpdir = tempfile.mkdtemp(prefix="ugly-test-")
+        self.imap = IMAPServer(reject=_rejected).start()
+        self.tokens = TokenServer().start()
+
+    def tearDown(self):
+        self.context.pop()
+        self.imap.stop()
+        self.tokens.stop()
+        shutil.rmtree(self.tmpdir)
+        logging.disable(logging.NOTSET)
+
+    def setup_app(self, tracking):
+        config = os.path.join(self.tmpdir, "config.py")
+        with open(config, "w") as f:
+            f.write("SQLALCHEMY_DATABASE_URI = {0!r}\n".format(
+                "sqlite:///" + os.path.join(self.tmpdir, "test.db")))
+        self.app = app = create_app(config)
+        app.config.update(IMAP_HOST=self.imap.host, IMAP_PORT=self.imap.port,
+                          IMAP_SSL=False, GOOGLE_TOKEN_URL=self.tokens.url,
+                          IMAP_APPEND_BATCH=3, APPEND_MAX_TRIES=3,
+                          DELIVERY_TRACKING=tracking)
+        upgrade(app)
+        self.context = app.test_request_context()
+        self.context.push()
+
+        feed = Feed("http://example.com/feed.xml")
+        feed.title = "Example"
+        user = User("test@example.com", "refresh")
+        db.session.add_all([feed, user])
+        db.session.flush()
+        user.subscribe(feed)
+        entries = [Entry(feed, feedparser.FeedParserDict(
+            id=str(i), link="http://example.com/{0}".format(i), title=t,
+            description="Entry {0}".format(i)))
+            for i, t in enumerate(self.titles)]
+        db.session.add_all(entries)
+        db.session.flush()
+        if tracking == "history":
+            db.session.execute(outbox.insert(), [
+                dict(user_id=user.id, entry_id=e.id) for e in entries])
+        db.session.commit()
+        return user, [e.id for e in entries]
+
+    def deliver(self, user):
+        count = user.deliver_entries()
+        db.session.commit()
+        return count
+
+    def watermark(self, user):
+        return db.session.query(subscriptions.c.last_entry_id) \
+            .filter(subscriptions.c.user_id == user.id).scalar()
+
+
+class RejectedAppendTest(DeliveryTest):
+
+    # The second of five entries is always rejected by the server.
+    titles = ["good 0", "bad", "good 2", "good 3", "good 4"]
+
+    def test_watermark(self):
+        user, ids = self.setup_app("watermark")
+
+        # Nothing is sent past the rejected entry until it's given up on.
+        self.assertEqual(self.deliver(user), 1)
+        self.assertEqual(self.deliver(user), 0)
+        self.assertEqual(self.deliver(user), 0)
+        self.assertEqual(self.imap.messages, 1)
+        self.assertEqual(self.watermark(user), ids[1])
+
+        self.assertEqual(self.deliver(user), 3)
+        self.assertEqual(self.deliver(user), 0)
+        self.assertEqual(self.imap.messages, 4)
+        self.assertEqual(self.watermark(user), ids[-1])
+
+    def test_history(self):
+        user, ids = self.setup_app("history")
+        self.assertEqual(db.session.query(outbox).count(), 5)
+
+        self.assertEqual(self.deliver(user), 4)
+        self.assertEqual(self.deliver(user), 0)
+        self.assertEqual(self.deliver(user), 0)
+        self.assertEqual(self.deliver(user), 0)
+        self.assertEqual(self.imap.messages, 4)
+        self.assertEqual(db.session.query(outbox).count(), 0)
+
+
+class TrackingSwitchTest(DeliveryTest):
+
+    def test_back_to_history(self):
+        user, ids = self.setup_app("watermark")
+        self.assertEqual(self.deliver(user), 5)
+
+        # The entries that arrive in "watermark" mode aren't queued.
+        feed = Feed.query.first()
+        db.session.add_all([Entry(feed, feedparser.FeedParserDict(
+            id="new {0}".format(i), link="http://example.com/new",
+            title="new {0}".format(i), description="New entry"))
+            for i in range(3)])
+        db.session.commit()
+        self.assertEqual(db.session.query(outbox).count(), 0)
+
+        # They are once the mode is switched back.
+        self.app.config["DELIVERY_TRACKING"] = "history"
+        self.assertTrue(sync_tracking(self.app))
+        self.assertFalse(sync_tracking(self.app))
+        self.assertEqual(db.session.query(outbox).count(), 3)
+        self.assertEqual(self.deliver(user), 3)
+        self.assertEqual(self.deliver(user), 0)
+        self.assertEqual(self.imap.messages, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
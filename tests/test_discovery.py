@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+from ugly import create_app
+from ugly.database import db
+from ugly.migrations import upgrade
+from ugly.models import User
+from ugly.discovery import normalize_url
+
+
+class NormalizeURLTest(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize_url(" xkcd.com "), "http://xkcd.com/")
+        self.assertEqual(normalize_url("HTTP://XKCD.com:80/atom.xml#top"),
+                         "http://xkcd.com/atom.xml")
+        self.assertEqual(normalize_url("https://example.com:8443"),
+                         "https://example.com:8443/")
+
+    def test_invalid_port(self):
+        for url in ("http://host:abc/", "host:abc", "http://host:99999/"):
+            self.assertRaises(ValueError, normalize_url, url)
+
+
+class SubscribeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="ugly-test-")
+        config = os.path.join(self.tmpdir, "config.py")
+        with open(config, "w") as f:
+            f.write("SQLALCHEMY_DATABASE_URI = {0!r}\n".format(
+                "sqlite:///" + os.path.join(self.tmpdir, "test.db")))
+        self.app = create_app(config)
+        upgrade(self.app)
+        with self.app.test_request_context():
+            user = User("test@example.com", "refresh")
+            user.api_token = "token"
+            db.session.add(user)
+            db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_invalid_url(self):
+        r = self.app.test_client().post("/api/subscribe", data=dict(
+            token="token", url="http://host:abc/"))
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(json.loads(r.data)["message"], "Invalid URL.")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,21 +4,28 @@
 __all__ = ["api"]
 
 import flask
-import feedfinder2
+from hashlib import sha1
 from functools import wraps
+from sqlalchemy import func
 from flask.ext.login import current_user
 
 from .database import db
-from .models import User, Feed
+from .jobs import get_job_queue
+from .discovery import normalize_url
+from .models import User, Feed, subscriptions
 
 api = flask.Blueprint("api", __name__)
 
 
 def _get_user():
-    token = flask.request.values.get("token")
-    if token is not None:
-        return User.query.filter_by(api_token=token).first()
-    return current_user
+    # The user is only looked up once per request (by the indexed token).
+    if not hasattr(flask.g, "api_user"):
+        token = flask.request.values.get("token")
+        if token is not None:
+            flask.g.api_user = User.query.filter_by(api_token=token).first()
+        else:
+            flask.g.api_user = current_user
+    return flask.g.api_user
 
 
 def private_view(func):
@@ -55,11 +62,56 @@ def new_key():
 @api.route("/feeds")
 @private_view
 def feeds():
-    feeds = _get_user().feeds
-    return flask.jsonify(
-        count=len(feeds),
-        feeds=[feed.to_dict() for feed in feeds],
+    user = _get_user()
+    args = flask.request.args
+
+    # Parse the arguments.
+    try:
+        cursor = int(args.get("cursor", 0))
+        limit = args.get("limit")
+        if limit is not None:
+            limit = min(int(limit), flask.current_app.config["API_PAGE_SIZE"])
+            assert limit > 0
+    except (ValueError, AssertionError):
+        return flask.jsonify(message="Invalid cursor or limit."), 400
+    fields = Feed.fields
+    if "fields" in args:
+        fields = [f for f in args["fields"].split(",") if f]
+        if not len(fields) or any(f not in Feed.fields for f in fields):
+            return flask.jsonify(message="Invalid fields. Choose from: {0}"
+                                 .format(", ".join(Feed.fields))), 400
+
+    # The list only changes when the subscription version does so there's
+    # no need to touch the feeds if the client's copy is up to date.
+    etag = sha1("{0}:{1}:{2}:{3}:{4}".format(
+        user.id, user.subscription_version or 0, cursor, limit,
+        ",".join(fields))).hexdigest()
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    # Get a page of feeds in id order.
+    columns = [getattr(Feed, f) for f in fields]
+    query = db.session.query(Feed.id, *columns) \
+        .join(subscriptions, subscriptions.c.feed_id == Feed.id) \
+        .filter(subscriptions.c.user_id == user.id) \
+        .filter(Feed.id > cursor).order_by(Feed.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = query.all()
+
+    data = dict(
+        count=db.session.query(func.count(subscriptions.c.feed_id))
+        .filter(subscriptions.c.user_id == user.id).scalar(),
+        feeds=[dict(zip(fields, row[1:])) for row in rows[:limit]],
     )
+    if limit is not None and len(rows) > limit:
+        data["next"] = rows[limit - 1][0]
+
+    response = flask.jsonify(**data)
+    response.set_etag(etag)
+    return response
 
 
 @api.route("/feed/<int:feedid>", methods=["GET"])
@@ -86,6 +138,10 @@ def subscribe():
     add_url = flask.request.values.get("url")
     if add_url is None:
         return flask.jsonify(message="You must provide a URL."), 400
+    try:
+        normalize_url(add_url)
+    except ValueError:
+        return flask.jsonify(message="Invalid URL."), 400
 
     # Check to make sure that the user doesn't have too many subscriptions.
     user = _get_user()
@@ -94,42 +150,27 @@ def subscribe():
         return flask.jsonify(message="You're already subscribed to the "
                              "maximum number of feeds."), 400
 
-    # Try to find a feed below the requested resource.
-    urls = feedfinder2.find_feeds(add_url)
-    if not len(urls):
-        return flask.jsonify(message="The robot can't find a feed at that "
-                             "URL. Could you help it with a more specific "
-                             "link?"), 400
-    url = urls[0]
-
-    # See if the user is already subscribed to a feed at that URL.
-    feed = db.session.query(Feed).join(User.feeds) \
-        .filter(User.id == user.id) \
-        .filter(Feed.url == url).first()
-    if feed is not None:
-        return flask.jsonify(
-            message="You've already subscribed to {0}.".format(feed.title),
-            feed=feed.to_dict(),
-        )
+    # Finding and fetching the feed can be slow so it's done in the
+    # background.
+    job_id = get_job_queue().submit("subscribe", user.id, url=add_url)
+    url = flask.url_for(".job", job_id=job_id)
+    response = flask.jsonify(message="Looking for a feed...", job=job_id,
+                             status="pending", url=url)
+    response.status_code = 202
+    response.headers["Location"] = url
+    return response
 
-    # See if a feed object already exists for that URL.
-    feed = Feed.query.filter(Feed.url == url).first()
 
-    # If it doesn't, create a new one.
-    if feed is None:
-        feed = Feed(url)
-
-        # Update the feed immediately to get the title, etc.
-        feed.update_info()
-
-    # Subscribe the current user.
-    user.feeds.append(feed)
-    db.session.commit()
+@api.route("/jobs/<job_id>")
+@private_view
+def job(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None or job["user_id"] != _get_user().id:
+        return flask.jsonify(message="Invalid job ID."), 400
 
-    return flask.jsonify(
-        message="Successfully subscribed to {0}.".format(feed.title),
-        feed=feed.to_dict(),
-    )
+    data = dict(job["result"] or {})
+    data.update(job=job["id"], status=job["status"], message=job["message"])
+    return flask.jsonify(**data)
 
 
 @api.route("/feed/<int:feedid>", methods=["DELETE"])
@@ -148,7 +189,7 @@ def unsubscribe(feedid):
 
     # Unsubscribe the user.
     title = feed.title
-    user.feeds.remove(feed)
+    user.unsubscribe(feed)
     db.session.commit()
 
     return flask.jsonify(message="Successfully unsubscribed from {0}."
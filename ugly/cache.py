@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__all__ = ["LRUCache"]
+
+import time
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    A thread safe, size limited dictionary that throws away the least
+    recently used items first. Items can optionally expire.
+
+    :param maxsize: (optional)
+        The maximum number of items to keep.
+
+    :param ttl: (optional)
+        The default number of seconds that an item stays valid for. If this
+        is ``None``, items never expire.
+
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _missing)
+            if item is _missing:
+                return default
+            value, expires = item
+            if expires is not None and expires <= time.time():
+                return default
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _missing)
+        if item is _missing:
+            return default
+        return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
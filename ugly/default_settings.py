@@ -9,9 +9,108 @@ BASE_MAILBOX = "[Ugly Reader]"
 AES_KEY = b"test AES key... change this in production"
 MAX_FEEDS = 100
 
+# The largest page of feeds returned by /api/feeds.
+API_PAGE_SIZE = 500
+
+# Background jobs (like subscribing to a new feed) are run by JOB_WORKERS
+# threads in the web process. Their state is kept for JOB_TTL seconds either
+# in memory ("local") or in the database ("database"). Use "database" if
+# more than one web process serves the API.
+JOB_QUEUE = "local"
+JOB_WORKERS = 4
+JOB_TTL = 3600
+JOB_CACHE_SIZE = 10000
+
+# The feeds found at a URL are remembered for DISCOVERY_TTL seconds. If none
+# were found, the URL is tried again after DISCOVERY_NEGATIVE_TTL seconds.
+DISCOVERY_TTL = 7 * 86400
+DISCOVERY_NEGATIVE_TTL = 600
+
+# Feed fetching stuff.
+FETCH_WORKERS = 16
+FETCH_PER_HOST = 2
+FETCH_POOL_HOSTS = 200
+FETCH_POOL_SIZE = 4
+FETCH_TIMEOUT = 30
+
+# Limits for very large feeds. Downloads stop after FETCH_MAX_BYTES bytes or
+# FEED_MAX_ITEMS items and ingestion stops after FEED_KNOWN_STOP entries in
+# a row that we already have. Set any of them to None to turn it off.
+FETCH_MAX_BYTES = 5 * 1024 * 1024
+FEED_MAX_ITEMS = 200
+FEED_KNOWN_STOP = 20
+
+# Feeds are polled adaptively between these intervals (in seconds), backing
+# off by a factor of POLL_BACKOFF each time a quiet feed is polled. When
+# uglyd runs with --daemon, it sleeps until the next feed is due.
+POLL_MIN_INTERVAL = 900
+POLL_MAX_INTERVAL = 86400
+POLL_BACKOFF = 1.5
+DAEMON_MIN_SLEEP = 30
+DAEMON_MAX_SLEEP = 900
+
+# To run more than one copy of uglyd, give each one a unique WORKER_ID (or
+# --worker-id). They then claim the feeds and users LEASE_BATCH at a time
+# with leases that are released as each one is done. A delivery renews its
+# lease for another LEASE_TTL seconds before and after each append and the
+# rows held by a crashed worker are picked up once its leases expire.
+WORKER_ID = None
+LEASE_TTL = 600
+LEASE_BATCH = 100
+
+# At the end of each run, uglyd writes its counters and timings to
+# METRICS_DIR as uglyd.prom (for Prometheus' textfile collector) and
+# uglyd.json (with the METRICS_TOP slowest feeds and users). Set to None to
+# turn it off or override it with --metrics-dir.
+METRICS_DIR = None
+METRICS_TOP = 10
+
+# With --profile <dir>, uglyd profiles each feed update and each delivery
+# and keeps the profiles of the ones that take longer than PROFILE_THRESHOLD
+# milliseconds (or --profile-threshold). Set PROFILE_SQL (or pass
+# --profile-sql) to record the SQL statements issued by each of them too.
+PROFILE_THRESHOLD = 1000
+PROFILE_SQL = False
+
+# Email delivery stuff.
+IMAP_HOST = "imap.gmail.com"
+IMAP_PORT = 993
+IMAP_SSL = True
+DELIVERY_WORKERS = 1
+IMAP_APPEND_BATCH = 50
+
+# Messages that the IMAP server rejects are tried again on the following runs
+# and given up on after APPEND_MAX_TRIES rejections in a row. Set it to None
+# to keep trying forever.
+APPEND_MAX_TRIES = 5
+
+# How to keep track of delivered entries. "history" records every delivered
+# entry in the user_entry table and "watermark" only stores the id of the
+# newest delivered entry for each subscription. Run
+# ugly.migrations.collapse_history before switching to "watermark". The
+# outbox isn't kept in "watermark" mode so, after switching back to
+# "history", the next uglyd run (or ugly.migrations.upgrade) queues up
+# everything above the watermarks again. In
+# "watermark" mode, unsubscribing keeps just the newest delivered entry of
+# the feed in user_entry so that resubscribing carries on from there.
+DELIVERY_TRACKING = "history"
+
+# Rendered emails are cached by entry. Bump the template version whenever
+# message.html changes.
+MESSAGE_TEMPLATE_VERSION = 1
+RENDER_CACHE_SIZE = 2000
+
 # Database stuff.
 SQLALCHEMY_DATABASE_URI = "postgresql://localhost/ugly"
 
 # Google OAuth stuff.
 GOOGLE_OAUTH2_CLIENT_ID = None
 GOOGLE_OAUTH2_CLIENT_SECRET = None
+GOOGLE_TOKEN_URL = "https://accounts.google.com/o/oauth2/token"
+
+# Access tokens are cached in memory (and in the database too if
+# TOKEN_STORE is "database") until TOKEN_REFRESH_MARGIN seconds before they
+# expire.
+TOKEN_STORE = "memory"
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_CACHE_SIZE = 10000
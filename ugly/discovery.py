@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A shared cache in front of :func:`feedfinder2.find_feeds` so that popular
+sites are only probed once in a while instead of once per subscriber.
+Results are stored under the normalized URL that was given and, if that URL
+was the root of a site, under the site's origin too so that ``xkcd.com``,
+``http://www.xkcd.com/`` and ``https://xkcd.com`` share one entry.
+
+"""
+
+__all__ = ["find_feeds", "normalize_url", "prune"]
+
+import flask
+import logging
+import urlparse
+import feedfinder2
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+
+from .database import db
+from .models import Discovery
+
+_default_ports = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """
+    Normalize a URL typed in by a user: add a missing scheme, lowercase the
+    scheme and host, drop the default port and the fragment and make sure
+    that there's a path. Raises a :class:`ValueError` if the URL can't be
+    parsed (if its port isn't a valid number, say).
+
+    :param url:
+        The URL.
+
+    """
+    url = url.strip()
+    if "://" not in url:
+        url = "http://" + url
+    try:
+        p = urlparse.urlsplit(url)
+        port = p.port
+    except ValueError:
+        raise ValueError("Invalid URL: {0}".format(url))
+
+    # Ports that are out of range come back as None instead of failing.
+    _, colon, explicit = p.netloc.rpartition("@")[2].rpartition(":")
+    if port is None and colon and explicit and not explicit.endswith("]"):
+        raise ValueError("Invalid port in URL: {0}".format(url))
+
+    scheme = p.scheme.lower()
+    host = (p.hostname or "").lower()
+    if port is not None and port != _default_ports.get(scheme):
+        host = "{0}:{1}".format(host, port)
+    return urlparse.urlunsplit((scheme, host, p.path or "/", p.query, ""))
+
+
+def _origin(url):
+    # The origin key for a normalized URL or None if it isn't a site root.
+    p = urlparse.urlsplit(url)
+    if p.path != "/" or p.query:
+        return None
+    host = p.netloc
+    if host.startswith("www."):
+        host = host[4:]
+    return "origin:" + host
+
+
+def _get(connection, keys):
+    table = Discovery.__table__
+    now = datetime.utcnow()
+    for key in keys:
+        row = connection.execute(table.select().where(table.c.key == key)
+                                 .where(table.c.expires > now)).first()
+        if row is not None:
+            return [u for u in (row.urls or "").split("\n") if u]
+    return None
+
+
+def _set(connection, keys, urls, ttl):
+    table = Discovery.__table__
+    expires = datetime.utcnow() + timedelta(seconds=ttl)
+    for key in keys:
+        connection.execute(table.delete().where(table.c.key == key))
+        connection.execute(table.insert().values(key=key,
+                                                 urls="\n".join(urls),
+                                                 expires=expires))
+
+
+def find_feeds(url):
+    """
+    Find the feeds at a URL using the cached result if there is one. New
+    results are kept for ``DISCOVERY_TTL`` seconds or, if no feeds were
+    found, for ``DISCOVERY_NEGATIVE_TTL`` seconds. The cache is written
+    outside of the current session so that the result is kept even if the
+    session is rolled back.
+
+    :param url:
+        The URL of a feed or of a page that links to one.
+
+    """
+    config = flask.current_app.config
+    engine = db.get_engine(flask.current_app)
+    url = normalize_url(url)
+    keys = [url]
+    origin = _origin(url)
+    if origin is not None:
+        keys.append(origin)
+
+    with engine.connect() as connection:
+        urls = _get(connection, keys)
+    if urls is not None:
+        logging.info("Using cached feed discovery for: {0}".format(url))
+        return urls
+
+    urls = feedfinder2.find_feeds(url)
+    ttl = config["DISCOVERY_TTL" if len(urls) else "DISCOVERY_NEGATIVE_TTL"]
+    try:
+        with engine.begin() as connection:
+            _set(connection, keys, urls, ttl)
+    except IntegrityError:
+        # Somebody else just cached the same URL.
+        pass
+    return urls
+
+
+def prune():
+    """
+    Remove the expired entries from the cache.
+
+    """
+    table = Discovery.__table__
+    with db.get_engine(flask.current_app).begin() as connection:
+        connection.execute(table.delete()
+                           .where(table.c.expires <= datetime.utcnow()))
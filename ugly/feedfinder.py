@@ -33,6 +33,12 @@ How it works:
   6. <A> links to feeds on external servers containing "rss", "rdf", "xml", or "atom"
   7. Try some guesses about common places for feeds (index.xml, atom.xml, etc.).
   8. As a last ditch effort, we search Syndic8 for feeds matching the URI
+
+The candidates from steps 2-7 are all checked at once by a small pool of
+threads, most likely first, and the search stops as soon as the best step
+that has a feed is known.  The whole search is limited to `timeout` seconds.
+Set FEEDFINDER_CACHE to a directory to keep robots.txt files there between
+runs (and share them between processes).
 """
 
 __version__ = "1.371"
@@ -46,38 +52,18 @@ Also Jason Diamond, Brian Lalor for bug reporting and patches"""
 
 _debug = 0
 
-import sgmllib, urllib, urlparse, re, sys, robotparser
-
-import threading
-class TimeoutError(Exception): pass
-def timelimit(timeout):
-    """borrowed from web.py"""
-    def _1(function):
-        def _2(*args, **kw):
-            class Dispatch(threading.Thread):
-                def __init__(self):
-                    threading.Thread.__init__(self)
-                    self.result = None
-                    self.error = None
-
-                    self.setDaemon(True)
-                    self.start()
-
-                def run(self):
-                    try:
-                        self.result = function(*args, **kw)
-                    except:
-                        self.error = sys.exc_info()
-
-            c = Dispatch()
-            c.join(timeout)
-            if c.isAlive():
-                raise TimeoutError, 'took too long'
-            if c.error:
-                raise c.error[0], c.error[1]
-            return c.result
-        return _2
-    return _1
+import sgmllib, urllib, urllib2, urlparse, re, sys, robotparser
+import os, time, threading, Queue, hashlib, tempfile, email.utils
+from collections import OrderedDict
+
+# robots.txt files are cached for as long as their Cache-Control or Expires
+# headers say (or ROBOTS_TTL seconds) but never for less than
+# ROBOTS_MIN_TTL or more than ROBOTS_MAX_TTL seconds.  If they can't be
+# fetched at all, they're tried again after ROBOTS_ERROR_TTL seconds.
+ROBOTS_TTL = 86400
+ROBOTS_MIN_TTL = 600
+ROBOTS_MAX_TTL = 86400
+ROBOTS_ERROR_TTL = 300
 
 # XML-RPC support allows feedfinder to query Syndic8 for possible matches.
 # Python 2.3 now comes with this module by default, otherwise you can download it
@@ -96,47 +82,151 @@ if not dict:
 def _debuglog(message):
     if _debug: print message
 
+def robotsTTL(headers):
+    """the number of seconds that a robots.txt response can be cached for"""
+    ttl = ROBOTS_TTL
+    expires = headers and headers.get('expires')
+    if expires:
+        date = email.utils.parsedate_tz(expires)
+        if date: ttl = email.utils.mktime_tz(date) - time.time()
+    cachecontrol = headers and headers.get('cache-control') or ''
+    for directive in cachecontrol.lower().split(','):
+        directive = directive.strip()
+        if directive in ('no-cache', 'no-store'):
+            ttl = 0
+        elif directive.startswith('max-age='):
+            try:
+                ttl = int(directive[8:])
+            except ValueError:
+                pass
+    return min(max(ttl, ROBOTS_MIN_TTL), ROBOTS_MAX_TTL)
+
 class URLGatekeeper:
-    """a class to track robots.txt rules across multiple servers"""
-    def __init__(self):
-        self.rpcache = {} # a dictionary of RobotFileParser objects, by domain
+    """a class to track robots.txt rules across multiple servers, keeping
+    the most recently used maxsize of them in memory (and, if cachedir is
+    given, all of them on disk where they're shared between processes)
+    until they expire"""
+    def __init__(self, maxsize=1000, cachedir=None):
+        self.maxsize = maxsize
+        self.cachedir = cachedir
+        # (expires, RobotFileParser) by site, least recently used first
+        self.rpcache = OrderedDict()
+        self.lock = threading.Lock()
         self.urlopener = urllib.FancyURLopener()
         self.urlopener.version = "feedfinder/" + __version__ + " " + self.urlopener.version + " +http://www.aaronsw.com/2002/feedfinder/"
         _debuglog(self.urlopener.version)
         self.urlopener.addheaders = [('User-agent', self.urlopener.version)]
         robotparser.URLopener.version = self.urlopener.version
         robotparser.URLopener.addheaders = self.urlopener.addheaders
+        # urllib2 is used for the actual requests since it has timeouts
+        self.opener = urllib2.build_opener()
+        self.opener.addheaders = self.urlopener.addheaders
 
-    def _getrp(self, url):
+    def _getrp(self, url, timeout=10):
         protocol, domain = urlparse.urlparse(url)[:2]
-        if self.rpcache.has_key(domain):
-            return self.rpcache[domain]
-        baseurl = '%s://%s' % (protocol, domain)
-        robotsurl = urlparse.urljoin(baseurl, 'robots.txt')
+        site = '%s://%s' % (protocol, domain)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            item = self.rpcache.pop(site, None)
+            if item is not None and item[0] > now:
+                self.rpcache[site] = item
+                return item[1]
+        finally:
+            self.lock.release()
+
+        record = self._load(site)
+        if record is None or record[0] <= now:
+            record = self._fetch(site, timeout)
+            self._save(site, record)
+        expires, status, lines = record
+        rp = robotparser.RobotFileParser(urlparse.urljoin(site, 'robots.txt'))
+        if status == 'disallow':
+            rp.disallow_all = True
+        elif status == 'allow':
+            rp.allow_all = True
+        elif status == 'rules':
+            rp.parse(lines)
+
+        self.lock.acquire()
+        try:
+            self.rpcache[site] = (expires, rp)
+            while len(self.rpcache) > self.maxsize:
+                self.rpcache.popitem(last=False)
+        finally:
+            self.lock.release()
+        return rp
+
+    def _fetch(self, site, timeout):
+        # the same rules as RobotFileParser.read, but with a timeout
+        robotsurl = urlparse.urljoin(site, 'robots.txt')
         _debuglog('fetching %s' % robotsurl)
-        rp = robotparser.RobotFileParser(robotsurl)
+        now = time.time()
         try:
-            rp.read()
+            f = self.opener.open(robotsurl, timeout=timeout)
+            return (now + robotsTTL(f.info()), 'rules',
+                    [line.strip() for line in f])
+        except urllib2.HTTPError, e:
+            if e.code in (401, 403):
+                return (now + robotsTTL(e.info()), 'disallow', [])
+            elif e.code >= 400 and e.code < 500:
+                return (now + robotsTTL(e.info()), 'allow', [])
         except:
             pass
-        self.rpcache[domain] = rp
-        return rp
+        return (now + ROBOTS_ERROR_TTL, 'error', [])
 
-    def can_fetch(self, url):
-        rp = self._getrp(url)
+    def _path(self, site):
+        return os.path.join(self.cachedir, hashlib.sha1(site).hexdigest())
+
+    def _load(self, site):
+        # a cache file has the expiry time and status, the site and then
+        # the lines of the robots.txt file
+        if not self.cachedir: return None
+        try:
+            f = open(self._path(site))
+            try:
+                expires, status = f.readline().split()
+                if f.readline().rstrip('\n') != site: return None
+                return (float(expires), status,
+                        [line.rstrip('\n') for line in f])
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, site, record):
+        if not self.cachedir: return
+        expires, status, lines = record
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # write a new file and move it into place so that other
+            # processes never see half of one
+            fd, tmp = tempfile.mkstemp(dir=self.cachedir)
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write('%f %s\n%s\n' % (expires, status, site))
+                f.write('\n'.join(lines))
+            finally:
+                f.close()
+            os.rename(tmp, self._path(site))
+        except (IOError, OSError), e:
+            _debuglog('could not cache robots.txt for %s: %s' % (site, e))
+
+    def can_fetch(self, url, timeout=10):
+        rp = self._getrp(url, timeout=timeout)
         allow = rp.can_fetch(self.urlopener.version, url)
         _debuglog("gatekeeper of %s says %s" % (url, allow))
         return allow
 
-    @timelimit(10)
-    def get(self, url, check=True):
-        if check and not self.can_fetch(url): return ''
+    def get(self, url, check=True, timeout=10):
+        if check and not self.can_fetch(url, timeout=timeout): return ''
         try:
-            return self.urlopener.open(url).read()
+            return self.opener.open(url, timeout=timeout).read()
         except:
             return ''
 
-_gatekeeper = URLGatekeeper()
+_gatekeeper = URLGatekeeper(cachedir=os.environ.get('FEEDFINDER_CACHE'))
 
 class BaseParser(sgmllib.SGMLParser):
     def __init__(self, baseuri):
@@ -224,13 +314,78 @@ def couldBeFeedData(data):
     if data.count('<html'): return 0
     return data.count('<rss') + data.count('<rdf') + data.count('<feed')
 
-def isFeed(uri):
+def isFeed(uri, timeout=10):
     _debuglog('seeing if %s is a feed' % uri)
     protocol = urlparse.urlparse(uri)
     if protocol[0] not in ('http', 'https'): return 0
-    data = _gatekeeper.get(uri)
+    data = _gatekeeper.get(uri, timeout=timeout)
     return couldBeFeedData(data)
 
+def probeFeeds(tiers, deadline, all=False, workers=8):
+    """check the candidate URIs in a list of tiers (most likely first) on a
+    pool of threads and return the feeds from the first tier that has any
+    (or from every tier if all is set) as soon as that's known, giving up
+    at the deadline"""
+    jobs, seen = [], {}
+    for i, tier in enumerate(tiers):
+        for uri in tier:
+            if seen.has_key(uri): continue
+            seen[uri] = i
+            jobs.append((i, uri))
+    pending = [0] * len(tiers)
+    for i, uri in jobs: pending[i] += 1
+    found = [[] for tier in tiers]
+    state = {'done': False}
+    cond = threading.Condition()
+    queue = Queue.Queue()
+    for job in jobs: queue.put(job)
+
+    def work():
+        while 1:
+            try:
+                i, uri = queue.get_nowait()
+            except Queue.Empty:
+                return
+            cond.acquire()
+            skip = state['done'] or (not all and filter(None, found[:i]))
+            cond.release()
+            timeout = deadline - time.time()
+            ok = not skip and timeout > 0 and isFeed(uri, timeout=timeout)
+            cond.acquire()
+            pending[i] -= 1
+            if ok: found[i].append(uri)
+            cond.notify()
+            cond.release()
+
+    def result():
+        if all:
+            if sum(pending): return None
+            return sum(found, [])
+        for i in range(len(tiers)):
+            if found[i]: return found[i]
+            if pending[i]: return None
+        return []
+
+    for n in range(min(workers, len(jobs))):
+        t = threading.Thread(target=work)
+        t.setDaemon(True)
+        t.start()
+    cond.acquire()
+    try:
+        while 1:
+            outfeeds = result()
+            timeout = deadline - time.time()
+            if outfeeds is not None or timeout <= 0: break
+            cond.wait(timeout)
+        state['done'] = True
+        if outfeeds is None:
+            _debuglog('out of time, using what we have')
+            outfeeds = [uri for tier in found for uri in tier]
+            if not all: outfeeds = outfeeds[:1]
+        return list(outfeeds)
+    finally:
+        cond.release()
+
 def sortFeeds(feed1Info, feed2Info):
     return cmp(feed2Info['headlines_rank'], feed1Info['headlines_rank'])
 
@@ -247,11 +402,14 @@ def getFeedsFromSyndic8(uri):
         pass
     return feeds
 
-def feeds(uri, all=False, querySyndic8=False, _recurs=None):
+def feeds(uri, all=False, querySyndic8=False, _recurs=None, timeout=10,
+          workers=8, _deadline=None):
     if _recurs is None: _recurs = [uri]
+    if _deadline is None: _deadline = time.time() + timeout
     fulluri = makeFullURI(uri)
     try:
-        data = _gatekeeper.get(fulluri, check=False)
+        data = _gatekeeper.get(fulluri, check=False,
+                               timeout=max(_deadline - time.time(), 0.1))
     except:
         return []
     # is this already a feed?
@@ -260,45 +418,43 @@ def feeds(uri, all=False, querySyndic8=False, _recurs=None):
     newuri = tryBrokenRedirect(data)
     if newuri and newuri not in _recurs:
         _recurs.append(newuri)
-        return feeds(newuri, all=all, querySyndic8=querySyndic8, _recurs=_recurs)
-    # nope, it's a page, try LINK tags first
+        return feeds(newuri, all=all, querySyndic8=querySyndic8, _recurs=_recurs,
+                     workers=workers, _deadline=_deadline)
+    # nope, it's a page, LINK tags are the best bet
     _debuglog('looking for LINK tags')
     try:
-        outfeeds = getLinks(data, fulluri)
+        linkfeeds = getLinks(data, fulluri)
     except:
-        outfeeds = []
-    _debuglog('found %s feeds through LINK tags' % len(outfeeds))
-    outfeeds = filter(isFeed, outfeeds)
-    if all or not outfeeds:
-        # no LINK tags, look for regular <A> links that point to feeds
-        _debuglog('no LINK tags, looking at A tags')
-        try:
-            links = getALinks(data, fulluri)
-        except:
-            links = []
-        locallinks = getLocalLinks(links, fulluri)
-        # look for obvious feed links on the same server
-        outfeeds.extend(filter(isFeed, filter(isFeedLink, locallinks)))
-        if all or not outfeeds:
-            # look harder for feed links on the same server
-            outfeeds.extend(filter(isFeed, filter(isXMLRelatedLink, locallinks)))
-        if all or not outfeeds:
-            # look for obvious feed links on another server
-            outfeeds.extend(filter(isFeed, filter(isFeedLink, links)))
-        if all or not outfeeds:
-            # look harder for feed links on another server
-            outfeeds.extend(filter(isFeed, filter(isXMLRelatedLink, links)))
-    if all or not outfeeds:
-        _debuglog('no A tags, guessing')
-        suffixes = [ # filenames used by popular software:
-          'atom.xml', # blogger, TypePad
-          'index.atom', # MT, apparently
-          'index.rdf', # MT
-          'rss.xml', # Dave Winer/Manila
-          'index.xml', # MT
-          'index.rss' # Slash
-        ]
-        outfeeds.extend(filter(isFeed, [urlparse.urljoin(fulluri, x) for x in suffixes]))
+        linkfeeds = []
+    _debuglog('found %s feeds through LINK tags' % len(linkfeeds))
+    # then regular <A> links that point to feeds
+    try:
+        links = getALinks(data, fulluri)
+    except:
+        links = []
+    locallinks = getLocalLinks(links, fulluri)
+    # and then some guesses
+    suffixes = [ # filenames used by popular software:
+      'atom.xml', # blogger, TypePad
+      'index.atom', # MT, apparently
+      'index.rdf', # MT
+      'rss.xml', # Dave Winer/Manila
+      'index.xml', # MT
+      'index.rss' # Slash
+    ]
+    tiers = [
+      linkfeeds,
+      # obvious feed links on the same server
+      filter(isFeedLink, locallinks),
+      # less obvious feed links on the same server
+      filter(isXMLRelatedLink, locallinks),
+      # obvious feed links on another server
+      filter(isFeedLink, links),
+      # less obvious feed links on another server
+      filter(isXMLRelatedLink, links),
+      [urlparse.urljoin(fulluri, x) for x in suffixes],
+    ]
+    outfeeds = probeFeeds(tiers, _deadline, all=all, workers=workers)
     if (all or not outfeeds) and querySyndic8:
         # still no luck, search Syndic8 for feeds (requires xmlrpclib)
         _debuglog('still no luck, searching Syndic8')
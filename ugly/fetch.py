@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__all__ = ["FeedFetcher", "get_fetcher"]
+
+import flask
+import logging
+import requests
+import threading
+import feedparser
+from hashlib import sha1
+from xml.parsers import expat
+from requests.adapters import HTTPAdapter
+
+from .metrics import metrics
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+class _Enough(Exception):
+    pass
+
+
+class ItemCounter(object):
+    """
+    Scan a feed incrementally, as it downloads, to find where the ``n``-th
+    RSS ``item`` or Atom ``entry`` ends. If the document isn't well formed
+    XML, the scanner gives up and :attr:`failed` is set.
+
+    :param n:
+        The number of items to look for.
+
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.count = 0
+        self.end = None
+        self.failed = False
+        self.parser = expat.ParserCreate()
+        self.parser.EndElementHandler = self._end
+
+    def _end(self, name):
+        if name.rsplit(":", 1)[-1].lower() in ("item", "entry"):
+            self.count += 1
+            if self.count >= self.n:
+                # The index has moved on by the time the exception is caught.
+                self.end = self.parser.CurrentByteIndex
+                raise _Enough()
+
+    def feed(self, chunk):
+        """
+        Scan the next chunk of the document. Once the ``n``-th item has been
+        found, this returns the offset of its end tag in the document.
+        Until then, it returns ``None``.
+
+        """
+        if self.failed:
+            return None
+        try:
+            self.parser.Parse(chunk)
+        except _Enough:
+            return self.end
+        except expat.ExpatError:
+            self.failed = True
+        return None
+
+
+class FeedFetcher(object):
+    """
+    Fetch and parse feeds over a shared pool of keep-alive HTTP connections.
+    The response bodies are downloaded (compressed where the server allows
+    it) by :mod:`requests` and then handed to :mod:`feedparser` so that the
+    connections can be reused across the feeds on the same host. It's safe
+    to share one fetcher between threads.
+
+    :param pool_hosts: (optional)
+        The number of per-host connection pools to keep around.
+
+    :param pool_size: (optional)
+        The maximum number of connections kept open to any one host.
+
+    :param timeout: (optional)
+        The socket timeout in seconds.
+
+    :param max_bytes: (optional)
+        The maximum number of (uncompressed) bytes to download for one feed.
+
+    :param max_items: (optional)
+        Stop downloading once this many items have been seen. Only the
+        items before this point are parsed.
+
+    """
+
+    def __init__(self, pool_hosts=100, pool_size=4, timeout=30,
+                 max_bytes=None, max_items=None):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.session = requests.Session()
+        self.session.headers.update({
+            "User-Agent": feedparser.USER_AGENT,
+            "Accept": feedparser.ACCEPT_HEADER,
+            "Accept-Encoding": "gzip, deflate",
+        })
+        for prefix in ("http://", "https://"):
+            self.session.mount(prefix, HTTPAdapter(pool_connections=pool_hosts,
+                                                   pool_maxsize=pool_size))
+
+    def get(self, url, etag=None, modified=None):
+        """
+        Do a conditional ``GET`` and return the :class:`requests.Response`.
+        Redirects are followed. The body isn't downloaded yet, use
+        :func:`read` for that.
+
+        """
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if modified is not None:
+            headers["If-Modified-Since"] = modified
+        return self.session.get(url, headers=headers, timeout=self.timeout,
+                                stream=True)
+
+    def read(self, r):
+        """
+        Download the body of a response, stopping at ``max_bytes`` or
+        after the first ``max_items`` items. Returns the body and whether
+        or not it was truncated.
+
+        """
+        counter = None
+        if self.max_items:
+            counter = ItemCounter(self.max_items)
+
+        chunks, size = [], 0
+        body, truncated = None, False
+        for chunk in r.iter_content(64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            end = None if counter is None else counter.feed(chunk)
+            if end is not None:
+                body = "".join(chunks)
+                body = body[:body.index(">", end) + 1]
+                truncated = True
+                break
+            if self.max_bytes and size >= self.max_bytes:
+                logging.warn("Truncated feed at {0} bytes: {1}"
+                             .format(size, r.url))
+                body = "".join(chunks)[:self.max_bytes]
+                truncated = True
+                break
+
+        # The rest of a truncated response is still on the wire so the
+        # connection can't go back into the pool as it is.
+        if truncated and getattr(r.raw, "_connection", None) is not None:
+            r.raw._connection.close()
+        r.close()
+
+        if body is None:
+            body = "".join(chunks)
+        return body, truncated
+
+    def fetch(self, url, etag=None, modified=None, digest=None):
+        """
+        Do a conditional fetch and parse of a feed. The result looks like
+        the output of :func:`feedparser.parse` including the ``status``,
+        ``href``, ``etag``, ``modified`` and ``headers`` keys plus the
+        ``digest`` of the body and whether or not it was ``truncated``.
+        Like :func:`feedparser.parse`, network errors are reported by
+        leaving out ``status`` and setting ``bozo_exception``. The body of
+        an HTTP error (a ``status`` of 400 or more) isn't downloaded or
+        parsed.
+
+        :param url:
+            The URL of the feed.
+
+        :param etag: (optional)
+            The ``ETag`` returned by the last fetch.
+
+        :param modified: (optional)
+            The ``Last-Modified`` header returned by the last fetch.
+
+        :param digest: (optional)
+            The digest of the body returned by the last fetch. If the new
+            body has the same digest, it isn't parsed and the result has
+            ``unchanged`` set instead.
+
+        """
+        try:
+            with metrics.timer("fetch", unit=url):
+                r = self.get(url, etag=etag, modified=modified)
+                if r.status_code >= 400:
+                    r.close()
+                    body, truncated = "", False
+                else:
+                    body, truncated = self.read(r)
+        except requests.RequestException as e:
+            logging.warn("Couldn't fetch {0}: {1}".format(url, e))
+            metrics.inc("fetches", status="error")
+            return feedparser.FeedParserDict(bozo=1, bozo_exception=e,
+                                             feed=feedparser.FeedParserDict(),
+                                             entries=[])
+        metrics.inc("fetches", status=r.status_code)
+        metrics.inc("fetch_bytes", len(body))
+        tree = self.parse(r, body, digest=digest)
+        tree["truncated"] = truncated
+        return tree
+
+    def parse(self, r, body, digest=None):
+        """
+        Parse a feed from a :class:`requests.Response` and its body unless
+        the body matches ``digest``.
+
+        """
+        # The body has already been decompressed.
+        headers = dict((k.lower(), v) for k, v in r.headers.items()
+                       if k.lower() != "content-encoding")
+        headers["content-location"] = r.url
+
+        # Error pages and 304s aren't hashed or parsed.
+        new_digest = None
+        unchanged = False
+        empty = r.status_code == 304 or r.status_code >= 400
+        if not empty:
+            new_digest = sha1(body).hexdigest()
+            unchanged = new_digest == digest
+        if empty or unchanged:
+            tree = feedparser.FeedParserDict(feed=feedparser.FeedParserDict(),
+                                             entries=[], bozo=0)
+        else:
+            with metrics.timer("parse", unit=r.url):
+                tree = feedparser.parse(body, response_headers=headers)
+
+        # Like feedparser, a permanent redirect is reported as a 301 unless
+        # it led to an error.
+        status = r.status_code
+        if status < 400 and len(r.history) and \
+                r.history[0].status_code == 301:
+            status = 301
+
+        tree["status"] = status
+        tree["href"] = r.url
+        tree["etag"] = headers.get("etag")
+        tree["modified"] = headers.get("last-modified")
+        tree["headers"] = headers
+        tree["digest"] = new_digest
+        tree["unchanged"] = unchanged
+        return tree
+
+
+def get_fetcher():
+    """
+    Get the fetcher shared by the whole process, configured by the
+    ``FETCH_POOL_HOSTS``, ``FETCH_POOL_SIZE``, ``FETCH_TIMEOUT``,
+    ``FETCH_MAX_BYTES`` and ``FEED_MAX_ITEMS`` config options. This needs
+    an application context but the fetcher itself can then be used from any
+    thread.
+
+    """
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            config = flask.current_app.config
+            _fetcher = FeedFetcher(pool_hosts=config["FETCH_POOL_HOSTS"],
+                                   pool_size=config["FETCH_POOL_SIZE"],
+                                   timeout=config["FETCH_TIMEOUT"],
+                                   max_bytes=config["FETCH_MAX_BYTES"],
+                                   max_items=config["FEED_MAX_ITEMS"])
+    return _fetcher
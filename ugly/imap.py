@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__all__ = ["MailboxCache", "append_messages", "copy_messages"]
+
+import re
+import logging
+import imaplib
+
+from .metrics import metrics
+
+_appenduid = re.compile(r"\[APPENDUID ([0-9]+) ([0-9:,]+)\]")
+_list = re.compile(r'\((?P<flags>[^)]*)\) (?P<delim>"[^"]*"|NIL) (?P<name>.*)')
+
+
+def _unquote(name):
+    if len(name) >= 2 and name[0] == name[-1] == '"':
+        name = re.sub(r'\\(.)', r'\1', name[1:-1])
+    return name
+
+
+def list_mailboxes(connection):
+    """
+    Get the names of all of the mailboxes on the server with one ``LIST``.
+
+    """
+    metrics.inc("imap_round_trips", command="LIST")
+    status, data = connection.list()
+    if status != "OK":
+        raise connection.error("LIST failed: {0}".format(data))
+    names = set()
+    for item in data:
+        # Names that need a literal are returned as a tuple.
+        if isinstance(item, tuple):
+            names.add(item[1])
+            continue
+        m = _list.match(item or "")
+        if m is not None:
+            names.add(_unquote(m.group("name")))
+    return names
+
+
+class MailboxCache(object):
+    """
+    Keep track of which mailboxes exist so that they only need to be created
+    when they're actually missing. If the known mailboxes aren't given, they
+    are listed (once) the first time that they're needed.
+
+    :param connection:
+        An authenticated :class:`imaplib.IMAP4` connection.
+
+    :param known: (optional)
+        The names of the mailboxes known to exist from a previous session.
+
+    """
+
+    def __init__(self, connection, known=None):
+        self.connection = connection
+        self.known = None if known is None else set(known)
+        self.changed = False
+
+    def create(self, name):
+        metrics.inc("imap_round_trips", command="CREATE")
+        self.connection.create(name)
+        self.known.add(name)
+        self.changed = True
+
+    def ensure(self, name):
+        if self.known is None:
+            self.known = list_mailboxes(self.connection)
+            self.changed = True
+        if name not in self.known:
+            self.create(name)
+
+    def select(self, name):
+        self.ensure(name)
+        metrics.inc("imap_round_trips", command="SELECT")
+        status, data = self.connection.select(name)
+        if status != "OK":
+            # Our list is out of date so try creating it again.
+            self.create(name)
+            metrics.inc("imap_round_trips", command="SELECT")
+            status, data = self.connection.select(name)
+        return status, data
+
+
+def parse_uid_set(uid_set):
+    """
+    Expand an IMAP UID set (like ``"3:5,9"``) into a list of UIDs.
+
+    """
+    uids = []
+    for part in uid_set.split(","):
+        if ":" in part:
+            a, b = sorted(map(int, part.split(":")))
+            uids += range(a, b + 1)
+        else:
+            uids.append(int(part))
+    return uids
+
+
+def format_uid_set(uids):
+    """
+    The inverse of :func:`parse_uid_set`. Runs of consecutive UIDs are
+    collapsed into ranges.
+
+    """
+    uids = sorted(set(map(int, uids)))
+    ranges = []
+    for uid in uids:
+        if len(ranges) and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else "{0}:{1}".format(a, b)
+                    for a, b in ranges)
+
+
+def _uids(data):
+    # Find the UIDs in the APPENDUID response code (RFC 4315), if any.
+    m = _appenduid.search(data[0] or "")
+    if m is None:
+        return []
+    return parse_uid_set(m.group(2))
+
+
+def _start(connection):
+    # Do the same housekeeping as imaplib does before a command.
+    if connection.state not in imaplib.Commands["APPEND"]:
+        raise connection.error("APPEND illegal in state {0}"
+                               .format(connection.state))
+    for typ in ("OK", "NO", "BAD"):
+        connection.untagged_responses.pop(typ, None)
+
+
+def _literal(ts, message):
+    # A date and a non-synchronizing literal (RFC 2088).
+    message = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+    return "{0} {{{1}+}}{2}{3}".format(imaplib.Time2Internaldate(ts),
+                                       len(message), imaplib.CRLF, message)
+
+
+def _multiappend(connection, mailbox, messages):
+    # Send all of the messages in one command (RFC 3502). The command is
+    # all or nothing so None is returned if it failed.
+    _start(connection)
+    tag = connection._new_tag()
+    connection.send("{0} APPEND {1} {2}{3}".format(
+        tag, connection._checkquote(mailbox),
+        " ".join(_literal(ts, msg) for ts, msg in messages), imaplib.CRLF))
+    metrics.inc("imap_round_trips", command="APPEND")
+    status, data = connection._command_complete("APPEND", tag)
+    if status != "OK":
+        logging.warn(data)
+        return None
+    return ["OK"] * len(messages), _uids(data)
+
+
+def _pipelined_append(connection, mailbox, messages):
+    # Send all of the APPENDs before waiting for any of the responses.
+    _start(connection)
+    mailbox = connection._checkquote(mailbox)
+    tags = []
+    for ts, msg in messages:
+        tag = connection._new_tag()
+        connection.send("{0} APPEND {1} {2}{3}".format(
+            tag, mailbox, _literal(ts, msg), imaplib.CRLF))
+        tags.append(tag)
+
+    # The responses all come back in one round trip.
+    metrics.inc("imap_round_trips", command="APPEND")
+    statuses, uids = [], []
+    for tag in tags:
+        status, data = connection._command_complete("APPEND", tag)
+        statuses.append(status)
+        if status != "OK":
+            logging.warn(data)
+            continue
+        uids += _uids(data)
+    return statuses, uids
+
+
+def _append_each(connection, mailbox, messages, stop=False):
+    # One round trip per message.
+    statuses, uids = [], []
+    for ts, msg in messages:
+        metrics.inc("imap_round_trips", command="APPEND")
+        status, data = connection.append(mailbox, None, ts, msg)
+        statuses.append(status)
+        if status != "OK":
+            logging.warn(data)
+            if stop:
+                break
+            continue
+        uids += _uids(data)
+    return statuses, uids
+
+
+def append_messages(connection, mailbox, messages, batch=50, stop=False):
+    """
+    Append a list of messages to a mailbox. Returns the status of the
+    ``APPEND`` of each message (``"OK"``, ``"NO"``, etc. or ``None`` if it
+    wasn't sent) and the UIDs that the server assigned to them (if it
+    supports ``UIDPLUS``). If the server supports ``MULTIAPPEND`` and
+    ``LITERAL+``, the messages are sent in batches of ``batch`` per command
+    and, if a batch is rejected, its messages are sent again one per
+    command so that one bad message doesn't take the rest of the batch down
+    with it. If it only supports ``LITERAL+``, the ``APPEND`` commands are
+    pipelined in batches instead. Otherwise, each message takes one round
+    trip.
+
+    :param connection:
+        An authenticated :class:`imaplib.IMAP4` connection.
+
+    :param mailbox:
+        The name of the mailbox.
+
+    :param messages:
+        A list of ``(timestamp, message)`` tuples.
+
+    :param batch: (optional)
+        The maximum number of messages sent before waiting for a response.
+
+    :param stop: (optional)
+        Don't send anything after the first message that fails. The
+        ``APPEND`` commands aren't pipelined in this case.
+
+    """
+    capabilities = connection.capabilities
+    statuses, uids = [], []
+    if "LITERAL+" in capabilities:
+        multi = "MULTIAPPEND" in capabilities
+        for i in range(0, len(messages), batch):
+            chunk = messages[i:i + batch]
+            result = None
+            if multi:
+                result = _multiappend(connection, mailbox, chunk)
+            if result is None and stop:
+                result = _append_each(connection, mailbox, chunk, stop=True)
+            elif result is None:
+                result = _pipelined_append(connection, mailbox, chunk)
+            statuses += result[0]
+            uids += result[1]
+            if stop and len(statuses) and statuses[-1] != "OK":
+                break
+    else:
+        statuses, uids = _append_each(connection, mailbox, messages,
+                                      stop=stop)
+    return statuses + [None] * (len(messages) - len(statuses)), uids
+
+
+def copy_messages(connection, uids, mailbox):
+    """
+    Copy messages from the selected mailbox to another one with a single
+    ``UID COPY`` command.
+
+    :param connection:
+        An :class:`imaplib.IMAP4` connection with a mailbox selected.
+
+    :param uids:
+        The UIDs of the messages in the selected mailbox.
+
+    :param mailbox:
+        The name of the destination mailbox.
+
+    """
+    if not len(uids):
+        return None, None
+    metrics.inc("imap_round_trips", command="COPY")
+    return connection.uid("COPY", format_uid_set(uids), mailbox)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Background jobs for the slow parts of the web app (like finding and
+fetching a new feed) so that they don't tie up a web worker. Jobs are run
+by a pool of threads in the process that submitted them. Their state is
+kept either in memory (``JOB_QUEUE = "local"``) or in the ``jobs`` table
+(``JOB_QUEUE = "database"``) where it's shared by all of the web processes
+and where uglyd can pick up the jobs that were never started.
+
+"""
+
+__all__ = ["JobError", "LocalJobQueue", "DatabaseJobQueue", "get_job_queue"]
+
+import json
+import uuid
+import flask
+import logging
+import threading
+from Queue import Queue
+from datetime import datetime, timedelta
+
+from .cache import LRUCache
+from .database import db
+from .discovery import find_feeds
+from .models import User, Feed, Job
+
+JOBS = {}
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class JobError(Exception):
+    """
+    Raised by a job to fail with a message that can be shown to the user.
+
+    """
+
+
+def job(func):
+    """
+    Register a job function. It's called with a ``progress`` function (that
+    takes a status message), the id of the user who submitted the job and
+    the keyword arguments given to :func:`JobQueue.submit`. It should
+    return a JSON serializable ``dict``.
+
+    """
+    JOBS[func.__name__] = func
+    return func
+
+
+@job
+def subscribe(progress, user_id, url=None):
+    user = User.query.get(user_id)
+
+    # Try to find a feed below the requested resource.
+    progress("Looking for a feed at {0}...".format(url))
+    urls = find_feeds(url)
+    if not len(urls):
+        raise JobError("The robot can't find a feed at that URL. Could you "
+                       "help it with a more specific link?")
+    url = urls[0]
+
+    # See if the user is already subscribed to a feed at that URL.
+    feed = db.session.query(Feed).join(User.feeds) \
+        .filter(User.id == user.id) \
+        .filter(Feed.url == url).first()
+    if feed is not None:
+        return dict(
+            message="You've already subscribed to {0}.".format(feed.title),
+            feed=feed.to_dict(),
+        )
+
+    # See if a feed object already exists for that URL.
+    feed = Feed.query.filter(Feed.url == url).first()
+
+    # If it doesn't, create a new one.
+    if feed is None:
+        feed = Feed(url)
+
+        # Update the feed immediately to get the title, etc.
+        progress("Fetching {0}...".format(url))
+        feed.update_info()
+
+    # Subscribe the user.
+    user.subscribe(feed)
+    db.session.commit()
+
+    return dict(
+        message="Successfully subscribed to {0}.".format(feed.title),
+        feed=feed.to_dict(),
+    )
+
+
+class JobQueue(object):
+    """
+    The base class for the job queues. Subclasses decide where the state of
+    the jobs is kept by implementing :func:`create`, :func:`claim`,
+    :func:`save` and :func:`get`. Jobs are represented as dictionaries with
+    the keys ``id``, ``user_id``, ``kind``, ``args``, ``status`` (one of
+    ``pending``, ``running``, ``done`` or ``failed``), ``message`` and
+    ``result``.
+
+    :param app:
+        The application that the jobs run in.
+
+    :param workers: (optional)
+        The number of threads that run jobs.
+
+    """
+
+    def __init__(self, app, workers=4):
+        self.app = app
+        self.workers = workers
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, kind, user_id, **kwargs):
+        """
+        Queue up a job and return its id straight away.
+
+        :param kind:
+            The name of the job function.
+
+        :param user_id:
+            The id of the user who submitted the job.
+
+        """
+        if kind not in JOBS:
+            raise ValueError("Unknown job: {0}".format(kind))
+        job_id = uuid.uuid4().hex
+        self.create(dict(id=job_id, user_id=user_id, kind=kind, args=kwargs,
+                         status="pending", message=None, result=None))
+        self._start()
+        self.queue.put(job_id)
+        return job_id
+
+    def _start(self):
+        # The threads are started lazily so that they're started after any
+        # forking by the web server. Any that have died are replaced.
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            with self.app.test_request_context():
+                try:
+                    self.run(job_id)
+                except Exception:
+                    # Claiming or saving the job failed so don't leave it
+                    # pending (or running) forever.
+                    logging.exception("Couldn't run job {0}".format(job_id))
+                    db.session.rollback()
+                    try:
+                        self.save(job_id, status="failed",
+                                  message="Something went wrong.")
+                    except Exception:
+                        logging.exception("Couldn't save job {0}"
+                                          .format(job_id))
+
+    def run(self, job_id):
+        """
+        Run a job if nobody else has claimed it yet. This needs a request
+        context. Returns ``True`` if the job was run.
+
+        """
+        job = self.claim(job_id)
+        if job is None:
+            return False
+
+        def progress(message):
+            self.save(job_id, message=message)
+
+        try:
+            result = JOBS[job["kind"]](progress, job["user_id"],
+                                       **job["args"])
+        except JobError as e:
+            db.session.rollback()
+            self.save(job_id, status="failed", message=unicode(e))
+        except Exception:
+            logging.exception("Job {0} failed".format(job_id))
+            db.session.rollback()
+            self.save(job_id, status="failed",
+                      message="Something went wrong.")
+        else:
+            self.save(job_id, status="done", message=result.get("message"),
+                      result=result)
+        return True
+
+    def run_pending(self):
+        """
+        Run any jobs that were never started by the process that submitted
+        them and return the number that were run.
+
+        """
+        return 0
+
+    def create(self, job):
+        raise NotImplementedError()
+
+    def claim(self, job_id):
+        """
+        Mark a pending job as running and return it, or ``None`` if it's
+        not pending anymore.
+
+        """
+        raise NotImplementedError()
+
+    def save(self, job_id, **kwargs):
+        raise NotImplementedError()
+
+    def get(self, job_id):
+        """
+        Get a job by id or ``None`` if it doesn't exist (or has expired).
+
+        """
+        raise NotImplementedError()
+
+
+class LocalJobQueue(JobQueue):
+    """
+    A job queue that keeps the jobs in memory for ``ttl`` seconds. This only
+    works if the status requests are served by the same process as the one
+    that submitted the job.
+
+    :param maxsize: (optional)
+        The maximum number of jobs to remember.
+
+    :param ttl: (optional)
+        The number of seconds to remember a job for.
+
+    """
+
+    def __init__(self, app, workers=4, maxsize=10000, ttl=3600):
+        super(LocalJobQueue, self).__init__(app, workers=workers)
+        self.jobs = LRUCache(maxsize, ttl=ttl)
+        self.jobs_lock = threading.Lock()
+
+    def create(self, job):
+        self.jobs.set(job["id"], job)
+
+    def claim(self, job_id):
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] != "pending":
+                return None
+            job["status"] = "running"
+            return dict(job)
+
+    def save(self, job_id, **kwargs):
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(kwargs)
+
+    def get(self, job_id):
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+
+class DatabaseJobQueue(JobQueue):
+    """
+    A job queue that keeps the jobs in the ``jobs`` table. The state is
+    written outside of the session used by the job itself so that progress
+    updates don't commit a half finished job.
+
+    :param ttl: (optional)
+        The number of seconds to keep finished jobs for.
+
+    """
+
+    def __init__(self, app, workers=4, ttl=3600):
+        super(DatabaseJobQueue, self).__init__(app, workers=workers)
+        self.ttl = ttl
+        self.table = Job.__table__
+
+    def _execute(self, statement):
+        with db.get_engine(self.app).begin() as connection:
+            return connection.execute(statement)
+
+    def create(self, job):
+        now = datetime.utcnow()
+        self._execute(self.table.insert().values(
+            id=job["id"], user_id=job["user_id"], kind=job["kind"],
+            args=json.dumps(job["args"]), status=job["status"],
+            created=now, updated=now))
+
+    def claim(self, job_id):
+        # Only one process can win the race to claim the job.
+        r = self._execute(self.table.update()
+                          .where(self.table.c.id == job_id)
+                          .where(self.table.c.status == "pending")
+                          .values(status="running",
+                                  updated=datetime.utcnow()))
+        if r.rowcount != 1:
+            return None
+        return self.get(job_id)
+
+    def save(self, job_id, **kwargs):
+        if "result" in kwargs:
+            kwargs["result"] = json.dumps(kwargs["result"])
+        kwargs["updated"] = datetime.utcnow()
+        self._execute(self.table.update().where(self.table.c.id == job_id)
+                      .values(**kwargs))
+
+    def get(self, job_id):
+        with db.get_engine(self.app).connect() as connection:
+            row = connection.execute(self.table.select()
+                                     .where(self.table.c.id == job_id)) \
+                .first()
+        if row is None:
+            return None
+        return dict(
+            id=row.id, user_id=row.user_id, kind=row.kind,
+            args=json.loads(row.args or "{}"), status=row.status,
+            message=row.message,
+            result=None if row.result is None else json.loads(row.result),
+        )
+
+    def run_pending(self):
+        # Throw away the old finished jobs.
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        self._execute(self.table.delete()
+                      .where(self.table.c.status.in_(["done", "failed"]))
+                      .where(self.table.c.updated < cutoff))
+
+        with db.get_engine(self.app).connect() as connection:
+            ids = [r.id for r in connection.execute(
+                self.table.select().where(self.table.c.status == "pending")
+                .order_by(self.table.c.created))]
+        return sum(self.run(job_id) for job_id in ids)
+
+
+def get_job_queue():
+    """
+    Get the job queue for this process. The type of queue is chosen by the
+    ``JOB_QUEUE`` config option (``"local"`` or ``"database"``) and it's
+    configured by ``JOB_WORKERS``, ``JOB_TTL`` and ``JOB_CACHE_SIZE``.
+
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            app = flask.current_app._get_current_object()
+            config = app.config
+            if config["JOB_QUEUE"] == "database":
+                _queue = DatabaseJobQueue(app, workers=config["JOB_WORKERS"],
+                                          ttl=config["JOB_TTL"])
+            elif config["JOB_QUEUE"] == "local":
+                _queue = LocalJobQueue(app, workers=config["JOB_WORKERS"],
+                                       maxsize=config["JOB_CACHE_SIZE"],
+                                       ttl=config["JOB_TTL"])
+            else:
+                raise ValueError("Unknown JOB_QUEUE: {0}"
+                                 .format(config["JOB_QUEUE"]))
+    return _queue
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Leases that let several copies of uglyd share the feeds and users without
+doing the same work twice. A worker claims a batch of rows by setting their
+``lease_owner`` and ``lease_expires`` columns with a conditional ``UPDATE``
+so that only one worker can win each row. The lease is renewed while the
+work is being done and released in the same commit as the results. If a
+worker dies, its leases expire and the rows are picked up by somebody else.
+
+"""
+
+__all__ = ["claim", "renew", "release"]
+
+import flask
+from datetime import datetime, timedelta
+from sqlalchemy import select, and_, or_
+
+from .database import db
+
+
+def claim(model, owner, criteria=(), limit=100, ttl=600, since=None):
+    """
+    Lease up to ``limit`` of the rows of a model that match some criteria
+    and that nobody holds a lease on. The claim is made outside of the
+    current session so that it's seen by the other workers straight away.
+    Returns the ids of the rows that were claimed. An empty list means that
+    there's nothing left to claim.
+
+    :param model:
+        The model class (:class:`Feed` or :class:`User`).
+
+    :param owner:
+        The id of the worker.
+
+    :param criteria: (optional)
+        A list of extra conditions on the rows.
+
+    :param limit: (optional)
+        The maximum number of rows to claim.
+
+    :param ttl: (optional)
+        The number of seconds that the leases last for.
+
+    :param since: (optional)
+        The time that this pass over the rows started. The rows that were
+        claimed or released (by anyone) since then aren't claimed again so
+        that each row is only worked on once per pass.
+
+    """
+    table = model.__table__
+    engine = db.get_engine(flask.current_app)
+    while True:
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=ttl)
+        if since is None:
+            free = or_(table.c.lease_expires == None,
+                       table.c.lease_expires <= now)
+        else:
+            free = or_(table.c.lease_expires == None,
+                       table.c.lease_expires < since)
+        with engine.begin() as connection:
+            ids = [r.id for r in connection.execute(
+                select([table.c.id]).where(and_(free, *criteria))
+                .order_by(table.c.id).limit(limit))]
+            if not len(ids):
+                return []
+
+            connection.execute(table.update()
+                               .where(table.c.id.in_(ids)).where(free)
+                               .values(lease_owner=owner,
+                                       lease_expires=expires))
+
+            # Some of the rows might have been claimed by another worker
+            # in the meantime.
+            won = [r.id for r in connection.execute(
+                select([table.c.id]).where(table.c.id.in_(ids))
+                .where(table.c.lease_owner == owner)
+                .where(table.c.lease_expires == expires))]
+
+        # If we lost all of them, try the next ones.
+        if len(won):
+            return won
+
+
+def renew(model, owner, id, ttl=600):
+    """
+    Extend a lease that we hold by another ``ttl`` seconds. Like
+    :func:`claim`, this is done in its own short transaction so that the row
+    isn't locked while the work goes on. Returns ``False`` if the lease has
+    expired or belongs to somebody else.
+
+    :param model:
+        The model class.
+
+    :param owner:
+        The id of the worker.
+
+    :param id:
+        The id of the row.
+
+    :param ttl: (optional)
+        The number of seconds that the lease lasts for from now.
+
+    """
+    table = model.__table__
+    now = datetime.utcnow()
+    with db.get_engine(flask.current_app).begin() as connection:
+        r = connection.execute(table.update()
+                               .where(table.c.id == id)
+                               .where(table.c.lease_owner == owner)
+                               .where(table.c.lease_expires > now)
+                               .values(lease_expires=now + timedelta(
+                                   seconds=ttl)))
+    return r.rowcount == 1
+
+
+def release(model, owner, ids):
+    """
+    Give up our leases on some rows. This is done in the current session so
+    that the rows are released in the same commit as the work on them.
+
+    :param model:
+        The model class.
+
+    :param owner:
+        The id of the worker.
+
+    :param ids:
+        The ids of the rows.
+
+    """
+    if not len(ids):
+        return
+    table = model.__table__
+    db.session.execute(table.update()
+                       .where(table.c.id.in_(ids))
+                       .where(table.c.lease_owner == owner)
+                       .values(lease_owner=None,
+                               lease_expires=datetime.utcnow()))
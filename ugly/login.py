@@ -18,7 +18,6 @@ login_manager = LoginManager()
 login_manager.login_view = "login.index"
 
 google_oauth2_url = "https://accounts.google.com/o/oauth2/auth"
-google_token_url = "https://accounts.google.com/o/oauth2/token"
 google_info_url = "https://www.googleapis.com/oauth2/v2/userinfo"
 
 
@@ -44,7 +43,8 @@ def oauth2callback():
         "redirect_uri": flask.url_for(".oauth2callback", _external=True),
         "grant_type": "authorization_code",
     }
-    r = requests.post(google_token_url, data=data)
+    r = requests.post(flask.current_app.config["GOOGLE_TOKEN_URL"],
+                      data=data)
     if r.status_code != requests.codes.ok:
         return flask.redirect(flask.url_for("frontend.index",
                                             error="Something went wrong with "
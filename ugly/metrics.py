@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Counters and timing histograms for uglyd. Everything is collected in the
+process-wide :data:`metrics` registry and, at the end of a run, written out
+as a Prometheus text file (for the node exporter's textfile collector) and a
+JSON summary with the slowest feeds and users. For example::
+
+    with metrics.timer("fetch", unit=url):
+        ...
+    metrics.inc("entries", len(entries))
+
+"""
+
+__all__ = ["Registry", "metrics"]
+
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# The histogram buckets in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total, result = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Registry(object):
+    """
+    A thread safe collection of counters and timing histograms. Timings can
+    also be attributed to a ``unit`` (like a feed URL or a user id) so that
+    the slowest ones can be reported.
+
+    :param prefix: (optional)
+        The prefix for the names of the exported metrics.
+
+    """
+
+    def __init__(self, prefix="ugly"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything that has been collected so far.
+
+        """
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+            self.units = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increment a counter.
+
+        :param name:
+            The name of the counter.
+
+        :param value: (optional)
+            The amount to increment it by.
+
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, unit=None):
+        """
+        Record a timing.
+
+        :param name:
+            The name of the histogram.
+
+        :param seconds:
+            The time taken.
+
+        :param unit: (optional)
+            The feed, user, etc. that the time was spent on.
+
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+            if unit is not None:
+                units = self.units.setdefault(name, {})
+                total, count = units.get(unit, (0.0, 0))
+                units[unit] = (total + seconds, count + 1)
+
+    @contextmanager
+    def timer(self, name, unit=None):
+        """
+        Time the body of a ``with`` statement with :func:`observe`. The time
+        is recorded even if the body raises an exception.
+
+        """
+        strt = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - strt, unit=unit)
+
+    def prometheus(self):
+        """
+        Format everything in the Prometheus text exposition format.
+
+        """
+        lines = []
+        with self.lock:
+            names = sorted(set(k[0] for k in self.counters))
+            for name in names:
+                metric = "{0}_{1}_total".format(self.prefix, name)
+                lines.append("# TYPE {0} counter".format(metric))
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append("{0}{1} {2}".format(
+                            metric, _labels(labels), value))
+
+            for name, histogram in sorted(self.histograms.items()):
+                metric = "{0}_{1}_seconds".format(self.prefix, name)
+                lines.append("# TYPE {0} histogram".format(metric))
+                for bound, count in histogram.cumulative():
+                    lines.append("{0}_bucket{{le=\"{1}\"}} {2}"
+                                 .format(metric, bound, count))
+                lines.append("{0}_bucket{{le=\"+Inf\"}} {1}"
+                             .format(metric, histogram.count))
+                lines.append("{0}_sum {1}".format(metric, histogram.sum))
+                lines.append("{0}_count {1}".format(metric, histogram.count))
+
+            metric = "{0}_last_run_timestamp_seconds".format(self.prefix)
+            lines.append("# TYPE {0} gauge".format(metric))
+            lines.append("{0} {1}".format(metric, time.time()))
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top=10):
+        """
+        Summarize everything as a dictionary including the ``top`` units
+        that took the longest for each timing.
+
+        :param top: (optional)
+            The number of units to list.
+
+        """
+        with self.lock:
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                if len(labels):
+                    name = "{0}{1}".format(name, _labels(labels))
+                counters[name] = value
+
+            timings = {}
+            for name, histogram in self.histograms.items():
+                timings[name] = dict(
+                    count=histogram.count, seconds=histogram.sum,
+                    mean=histogram.sum / histogram.count,
+                )
+                units = self.units.get(name)
+                if units:
+                    slowest = sorted(units.items(), key=lambda u: -u[1][0])
+                    timings[name]["slowest"] = [
+                        dict(unit=unit, seconds=total, count=count)
+                        for unit, (total, count) in slowest[:top]]
+
+            return dict(started=self.started,
+                        seconds=time.time() - self.started,
+                        counters=counters, timings=timings)
+
+    def write(self, directory, name="uglyd", top=10):
+        """
+        Write ``<name>.prom`` and ``<name>.json`` to a directory. The files
+        are replaced atomically so that they can be read at any time.
+
+        :param directory:
+            The directory to write the files to.
+
+        :param name: (optional)
+            The base name of the files.
+
+        :param top: (optional)
+            The number of slowest units to list in the summary.
+
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        _write(os.path.join(directory, name + ".prom"), self.prometheus())
+        _write(os.path.join(directory, name + ".json"),
+               json.dumps(self.summary(top=top), indent=2, sort_keys=True))
+
+
+def _labels(labels):
+    if not len(labels):
+        return ""
+    return "{" + ",".join("{0}=\"{1}\"".format(
+        k, unicode(v).replace("\\", "\\\\").replace("\"", "\\\""))
+        for k, v in labels) + "}"
+
+
+def _write(path, contents):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "w") as f:
+        f.write(contents)
+    os.rename(tmp, path)
+
+
+metrics = Registry()
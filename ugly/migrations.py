@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__all__ = ["upgrade", "collapse_history", "sync_tracking"]
+
+import logging
+from sqlalchemy import inspect, select
+
+from .database import db
+from . import models
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """
+    Register a migration. Migrations are run in the order that they're
+    defined and each one must check whether it has already been applied so
+    that :func:`upgrade` is safe to run against any version of the schema.
+
+    """
+    MIGRATIONS.append(func)
+    return func
+
+
+def _has_table(connection, table):
+    return table in inspect(connection).get_table_names()
+
+
+def _has_index(connection, table, name):
+    return name in [i["name"] for i in inspect(connection).get_indexes(table)]
+
+
+def _has_column(connection, table, name):
+    return name in [c["name"] for c in inspect(connection).get_columns(table)]
+
+
+def _create_index(connection, table, name):
+    [index] = [i for i in table.indexes if i.name == name]
+    index.create(bind=connection)
+
+
+def _set_watermarks(connection):
+    # The watermark sits just below the oldest pending entry or, if there
+    # isn't one, at the newest delivered entry. If some entries newer than
+    # the oldest pending one have already been delivered, they'll be sent
+    # again but nothing will be skipped.
+    connection.execute(
+        "UPDATE subscriptions SET last_entry_id = COALESCE("
+        "(SELECT MIN(o.entry_id) - 1 FROM outbox o "
+        "JOIN entries e ON e.id = o.entry_id "
+        "WHERE o.user_id = subscriptions.user_id "
+        "AND e.feed_id = subscriptions.feed_id), "
+        "(SELECT MAX(ue.entry_id) FROM user_entry ue "
+        "JOIN entries e ON e.id = ue.entry_id "
+        "WHERE ue.user_id = subscriptions.user_id "
+        "AND e.feed_id = subscriptions.feed_id))")
+
+
+def _fill_outbox(connection):
+    # Queue up everything above the watermarks that isn't queued already.
+    connection.execute(
+        "INSERT INTO outbox (user_id, entry_id) "
+        "SELECT s.user_id, e.id FROM subscriptions s "
+        "JOIN entries e ON e.feed_id = s.feed_id "
+        "WHERE e.id > COALESCE(s.last_entry_id, 0) AND NOT EXISTS "
+        "(SELECT 1 FROM outbox o "
+        "WHERE o.user_id = s.user_id AND o.entry_id = e.id)")
+
+
+def _sync_tracking(connection, mode):
+    settings = models.settings
+    name = settings.c.name == "delivery_tracking"
+
+    # Only one process gets to switch the mode.
+    switched = connection.execute(settings.update().where(name)
+                                  .where(settings.c.value != mode)
+                                  .values(value=mode)).rowcount
+    if switched:
+        if mode == "history":
+            _fill_outbox(connection)
+        logging.info("Switched the delivery tracking to: {0}".format(mode))
+    elif connection.execute(select([settings.c.value])
+                            .where(name)).scalar() is None:
+        connection.execute(settings.insert().values(name="delivery_tracking",
+                                                    value=mode))
+    return switched
+
+
+@migration
+def unique_entry_refs(connection):
+    name = "ix_entries_feed_id_ref"
+    if _has_index(connection, "entries", name):
+        return False
+
+    # Remove any duplicate entries that were created before the constraint
+    # existed, keeping the oldest copy.
+    dups = ("SELECT e.id FROM entries e WHERE EXISTS (SELECT 1 FROM entries d "
+            "WHERE d.feed_id = e.feed_id AND d.ref = e.ref AND d.id < e.id)")
+    connection.execute("DELETE FROM user_entry WHERE entry_id IN ({0})"
+                       .format(dups))
+    connection.execute("DELETE FROM entries WHERE id IN ({0})".format(dups))
+
+    _create_index(connection, models.Entry.__table__, name)
+    return True
+
+
+@migration
+def delivery_outbox(connection):
+    if _has_table(connection, "outbox"):
+        return False
+
+    # Queue up everything that hasn't been delivered yet.
+    models.outbox.create(bind=connection)
+    connection.execute(
+        "INSERT INTO outbox (user_id, entry_id) "
+        "SELECT s.user_id, e.id FROM subscriptions s "
+        "JOIN entries e ON e.feed_id = s.feed_id WHERE NOT EXISTS "
+        "(SELECT 1 FROM user_entry ue "
+        "WHERE ue.user_id = s.user_id AND ue.entry_id = e.id)")
+    return True
+
+
+@migration
+def subscription_watermarks(connection):
+    if _has_column(connection, "subscriptions", "last_entry_id"):
+        return False
+    connection.execute("ALTER TABLE subscriptions "
+                       "ADD COLUMN last_entry_id INTEGER")
+    _set_watermarks(connection)
+    _create_index(connection, models.Entry.__table__, "ix_entries_feed_id_id")
+    return True
+
+
+@migration
+def cached_access_tokens(connection):
+    if _has_column(connection, "users", "access_token"):
+        return False
+    connection.execute("ALTER TABLE users ADD COLUMN access_token VARCHAR")
+    connection.execute("ALTER TABLE users "
+                       "ADD COLUMN access_token_expires TIMESTAMP")
+    return True
+
+
+@migration
+def known_mailboxes(connection):
+    if _has_column(connection, "users", "mailboxes"):
+        return False
+    connection.execute("ALTER TABLE users ADD COLUMN mailboxes TEXT")
+    return True
+
+
+@migration
+def feed_schedule(connection):
+    if _has_column(connection, "feeds", "next_check_at"):
+        return False
+    for column in ("last_checked TIMESTAMP", "last_changed TIMESTAMP",
+                   "post_interval FLOAT", "next_check_at TIMESTAMP"):
+        connection.execute("ALTER TABLE feeds ADD COLUMN " + column)
+    _create_index(connection, models.Feed.__table__,
+                  "ix_feeds_next_check_at")
+    return True
+
+
+@migration
+def feed_digests(connection):
+    if _has_column(connection, "feeds", "body_digest"):
+        return False
+    connection.execute("ALTER TABLE feeds ADD COLUMN body_digest VARCHAR")
+    connection.execute("ALTER TABLE feeds ADD COLUMN entries_digest VARCHAR")
+    return True
+
+
+@migration
+def processed_bodies(connection):
+    if _has_column(connection, "entries", "content"):
+        return False
+    # The existing entries are processed when they're next delivered.
+    connection.execute("ALTER TABLE entries ADD COLUMN content TEXT")
+    connection.execute("ALTER TABLE entries "
+                       "ADD COLUMN content_version INTEGER")
+    return True
+
+
+@migration
+def user_lookup_indexes(connection):
+    applied = False
+    for name in ("ix_users_api_token", "ix_users_email_hash"):
+        if not _has_index(connection, "users", name):
+            _create_index(connection, models.User.__table__, name)
+            applied = True
+    return applied
+
+
+@migration
+def subscription_versions(connection):
+    if _has_column(connection, "users", "subscription_version"):
+        return False
+    connection.execute("ALTER TABLE users "
+                       "ADD COLUMN subscription_version INTEGER")
+    connection.execute("UPDATE users SET subscription_version = 0")
+    return True
+
+
+@migration
+def leases(connection):
+    applied = False
+    for table in ("feeds", "users"):
+        if _has_column(connection, table, "lease_owner"):
+            continue
+        connection.execute("ALTER TABLE {0} ADD COLUMN lease_owner VARCHAR"
+                           .format(table))
+        connection.execute("ALTER TABLE {0} ADD COLUMN lease_expires "
+                           "TIMESTAMP".format(table))
+        applied = True
+    return applied
+
+
+@migration
+def append_rejections(connection):
+    applied = False
+    for table in ("outbox", "subscriptions"):
+        if _has_column(connection, table, "rejections"):
+            continue
+        connection.execute("ALTER TABLE {0} ADD COLUMN rejections INTEGER"
+                           .format(table))
+        applied = True
+    return applied
+
+
+def upgrade(app):
+    """
+    Bring an existing database up to date with the current models. Any
+    outstanding migrations are applied in a single transaction and then the
+    remaining new tables are created. A fresh database is just created from
+    scratch.
+
+    :param app:
+        The application whose database should be upgraded.
+
+    """
+    engine = db.get_engine(app)
+    with engine.begin() as connection:
+        if _has_table(connection, "users"):
+            for func in MIGRATIONS:
+                if func(connection):
+                    logging.info("Applied migration: {0}"
+                                 .format(func.__name__))
+        db.Model.metadata.create_all(bind=connection)
+        _sync_tracking(connection, app.config["DELIVERY_TRACKING"])
+
+
+def collapse_history(app):
+    """
+    Collapse the per-entry delivery history into the per-subscription
+    watermarks and then empty the ``user_entry`` and ``outbox`` tables. Run
+    this (with uglyd stopped) before setting ``DELIVERY_TRACKING`` to
+    ``"watermark"``.
+
+    :param app:
+        The application whose database should be collapsed.
+
+    """
+    engine = db.get_engine(app)
+    with engine.begin() as connection:
+        _set_watermarks(connection)
+        connection.execute("DELETE FROM outbox")
+        connection.execute("DELETE FROM user_entry")
+
+
+def sync_tracking(app):
+    """
+    Get the database ready for the current ``DELIVERY_TRACKING`` mode. The
+    outbox isn't kept up to date in "watermark" mode so, when switching
+    back to "history", every entry above each subscription's watermark is
+    queued up again. The mode is remembered in the ``settings`` table. This
+    is run by :func:`upgrade` and at the start of every uglyd run. Returns
+    ``True`` if the mode was switched.
+
+    :param app:
+        The application whose database should be synced.
+
+    """
+    engine = db.get_engine(app)
+    with engine.begin() as connection:
+        if not _has_table(connection, "settings"):
+            return False
+        return bool(_sync_tracking(connection,
+                                   app.config["DELIVERY_TRACKING"]))
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-__all__ = ["hash_email", "User", "Feed", "Entry"]
+__all__ = ["hash_email", "fetch_feed", "User", "Feed", "Entry", "Job",
+           "Discovery"]
 
 import re
 import os
@@ -11,20 +12,41 @@ import logging
 import imaplib
 import requests
 import html2text
-import feedparser
 from hashlib import sha1
+from itertools import groupby
 from bs4 import BeautifulSoup
-from datetime import datetime
+from datetime import datetime, timedelta
 from SimpleAES import SimpleAES
-from email.utils import formatdate
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from sqlalchemy import (Column, Integer, String, Boolean, DateTime,
-                        ForeignKey, Table)
+from sqlalchemy import (Column, Integer, Float, String, Text, Boolean,
+                        DateTime, ForeignKey, Table, Index, select, func,
+                        and_)
 from sqlalchemy.orm import relationship
 
+from .cache import LRUCache
+from .imap import MailboxCache, append_messages, copy_messages
+from .fetch import get_fetcher
+from .metrics import metrics
 from .database import db
 
+_render_cache = None
+_token_cache = None
+_ciphers = {}
+
+# Bump this whenever process_body changes so that the stored bodies are
+# processed again the next time that they're used.
+BODY_VERSION = 1
+
+# lxml is much faster but it's optional.
+try:
+    import lxml  # NOQA
+except ImportError:
+    BODY_PARSER = "html.parser"
+else:
+    BODY_PARSER = "lxml"
+
 
 def hash_email(email):
     """
@@ -37,6 +59,19 @@ def hash_email(email):
     return sha1(email).hexdigest()
 
 
+def get_cipher():
+    """
+    Get the (stateless) cipher for the ``AES_KEY`` of the current app. One
+    cipher is kept per key for the lifetime of the process.
+
+    """
+    key = flask.current_app.config["AES_KEY"]
+    aes = _ciphers.get(key)
+    if aes is None:
+        aes = _ciphers.setdefault(key, SimpleAES(key))
+    return aes
+
+
 def encrypt_email(email):
     """
     The default encryption function for storing emails in the database. This
@@ -46,8 +81,7 @@ def encrypt_email(email):
         The email address.
 
     """
-    aes = SimpleAES(flask.current_app.config["AES_KEY"])
-    return aes.encrypt(email)
+    return get_cipher().encrypt(email)
 
 
 def decrypt_email(enc_email):
@@ -58,19 +92,166 @@ def decrypt_email(enc_email):
         The encrypted email address.
 
     """
-    aes = SimpleAES(flask.current_app.config["AES_KEY"])
-    return aes.decrypt(enc_email)
+    return get_cipher().decrypt(enc_email)
+
+
+def fetch_feed(url, etag=None, modified=None, digest=None):
+    """
+    Do a conditional fetch and parse of a feed using the shared fetcher
+    returned by :func:`ugly.fetch.get_fetcher`.
+
+    :param url:
+        The URL of the feed.
+
+    :param etag: (optional)
+        The ``ETag`` returned by the last fetch.
+
+    :param modified: (optional)
+        The ``Last-Modified`` header returned by the last fetch.
+
+    :param digest: (optional)
+        The digest of the body returned by the last fetch.
+
+    """
+    return get_fetcher().fetch(url, etag=etag, modified=modified,
+                               digest=digest)
+
+
+def poll_hint(tree):
+    """
+    Work out how long (in seconds) the server would like us to wait before
+    polling a feed again based on the ``Cache-Control`` and ``Expires``
+    headers and the RSS ``ttl`` element. Returns ``None`` if there's no
+    hint.
+
+    :param tree:
+        The parsed feed.
+
+    """
+    headers = dict((k.lower(), v)
+                   for k, v in (tree.get("headers") or {}).items())
+    hints = []
 
+    m = re.search(r"max-age=([0-9]+)", headers.get("cache-control", ""))
+    if m is not None:
+        hints.append(int(m.group(1)))
+    elif headers.get("expires"):
+        expires = parsedate_tz(headers["expires"])
+        if expires is not None:
+            hints.append(mktime_tz(expires) - time.time())
 
-# Association tables.
+    try:
+        hints.append(60 * int(tree.get("feed", {}).get("ttl")))
+    except (TypeError, ValueError):
+        pass
+
+    if not len(hints):
+        return None
+    return max(hints)
+
+
+def digest_entries(entries):
+    """
+    A digest of the ids and update times of a list of parsed entries. This
+    changes whenever an entry is added, removed or updated but not when
+    the rest of the document (a build date, say) changes.
+
+    :param entries:
+        The ``entries`` list from the parsed feed.
+
+    """
+    h = sha1()
+    for e in entries:
+        line = u"{0}\t{1}\n".format(e.get("id") or e.get("link"),
+                                    e.get("updated") or e.get("published"))
+        h.update(line.encode("utf-8"))
+    return h.hexdigest()
+
+
+def process_body(body):
+    """
+    Clean up the HTML body of an entry so that it can be embedded in an
+    email. At the moment, this just stops images from overflowing.
+
+    :param body:
+        The HTML body of the entry.
+
+    """
+    if not body:
+        return u""
+    soup = BeautifulSoup(body, BODY_PARSER)
+    for img in soup.find_all("img"):
+        img["style"] = "max-width:100%;"
+    # Some parsers wrap the fragment in a full document.
+    if soup.body is not None:
+        return soup.body.decode_contents()
+    return soup.decode()
+
+
+def get_render_cache():
+    """
+    Get the cache of rendered message parts shared by all of the deliveries
+    in this process. Its size is set by the ``RENDER_CACHE_SIZE`` config
+    option.
+
+    """
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = LRUCache(flask.current_app.config["RENDER_CACHE_SIZE"])
+    return _render_cache
+
+
+def get_token_cache():
+    """
+    Get the in-process cache of OAuth2 access tokens keyed by user id.
+
+    """
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = LRUCache(flask.current_app.config["TOKEN_CACHE_SIZE"])
+    return _token_cache
+
+
+def track_history():
+    """
+    Should deliveries be tracked per entry (using the ``outbox`` and
+    ``user_entry`` tables) or only with the per-subscription watermark? This
+    is set by the ``DELIVERY_TRACKING`` config option.
+
+    """
+    return flask.current_app.config["DELIVERY_TRACKING"] == "history"
+
+
+# Association tables. The ``last_entry_id`` column is the id of the newest
+# entry that has been delivered for that subscription and, in "watermark"
+# mode, ``rejections`` counts the times in a row that the IMAP server has
+# rejected the entry after it.
 subscriptions = Table("subscriptions", db.Model.metadata,
                       Column("user_id", Integer, ForeignKey("users.id")),
-                      Column("feed_id", Integer, ForeignKey("feeds.id")))
+                      Column("feed_id", Integer, ForeignKey("feeds.id")),
+                      Column("last_entry_id", Integer),
+                      Column("rejections", Integer))
 
 user_entry = Table("user_entry", db.Model.metadata,
                    Column("user_id", Integer, ForeignKey("users.id")),
                    Column("entry_id", Integer, ForeignKey("entries.id")))
 
+# Entries that are waiting to be delivered. One row is added per subscriber
+# when an entry is first seen and removed once it has been delivered (or
+# the IMAP server has rejected it ``rejections`` too many times).
+outbox = Table("outbox", db.Model.metadata,
+               Column("id", Integer, primary_key=True),
+               Column("user_id", Integer, ForeignKey("users.id"), index=True),
+               Column("entry_id", Integer, ForeignKey("entries.id")),
+               Column("rejections", Integer))
+
+# Things that uglyd needs to remember between runs, like the delivery
+# tracking mode that the outbox was last kept in (see
+# ugly.migrations.sync_tracking).
+settings = Table("settings", db.Model.metadata,
+                 Column("name", String, primary_key=True),
+                 Column("value", String))
+
 
 # Data models.
 class User(db.Model):
@@ -80,21 +261,35 @@ class User(db.Model):
     id = Column(Integer, primary_key=True)
 
     email = Column(String)
-    email_hash = Column(String)
+    email_hash = Column(String, index=True)
     joined = Column(DateTime)
 
     admin = Column(Boolean)
     active = Column(Boolean)
     refresh_token = Column(String)
 
-    api_token = Column(String)
+    api_token = Column(String, index=True)
+
+    access_token = Column(String)
+    access_token_expires = Column(DateTime)
+
+    # The newline separated names of the IMAP mailboxes known to exist.
+    mailboxes = Column(Text)
+
+    # Bumped whenever the subscription list (or the info of one of the
+    # subscribed feeds) changes. It's used for the API ETags.
+    subscription_version = Column(Integer, default=0)
+
+    # The uglyd worker delivering to this user and until when (see
+    # ugly.leases).
+    lease_owner = Column(String)
+    lease_expires = Column(DateTime)
 
     feeds = relationship("Feed", secondary=subscriptions, backref="users")
     entries = relationship("Entry", secondary=user_entry, backref="users")
 
     def __init__(self, email, refresh_token):
-        self.email = encrypt_email(email)
-        self.email_hash = hash_email(email)
+        self.set_email(email)
         self.refresh_token = refresh_token
 
         self.joined = datetime.utcnow()
@@ -106,8 +301,31 @@ class User(db.Model):
         return "<User(\"{0}\", \"{1}\")>".format(self.get_email(),
                                                  self.refresh_token)
 
+    def set_email(self, email):
+        """
+        Change the email address of this user, updating the encrypted and
+        hashed copies.
+
+        :param email:
+            The new email address.
+
+        """
+        self.email = encrypt_email(email)
+        self.email_hash = hash_email(email)
+        self._email = (self.email, email)
+
     def get_email(self):
-        return decrypt_email(self.email)
+        """
+        Get the decrypted email address. The result is remembered for as
+        long as the encrypted address doesn't change.
+
+        """
+        cached = getattr(self, "_email", None)
+        if cached is not None and cached[0] == self.email:
+            return cached[1]
+        email = decrypt_email(self.email)
+        self._email = (self.email, email)
+        return email
 
     def get_id(self):
         return self.id
@@ -124,38 +342,184 @@ class User(db.Model):
     def generate_token(self):
         return sha1(os.urandom(8)+self.get_email()+os.urandom(8)).hexdigest()
 
-    def get_oauth2_token(self):
+    def subscribe(self, feed):
+        self.feeds.append(feed)
+        self.subscription_version = (self.subscription_version or 0) + 1
+        if feed.id is None:
+            return
+        db.session.flush()
+
+        # Pick up where an earlier subscription to this feed left off (see
+        # unsubscribe) instead of sending the whole archive again.
+        if not track_history():
+            last = db.session.query(func.max(user_entry.c.entry_id)) \
+                .filter(user_entry.c.user_id == self.id) \
+                .filter(user_entry.c.entry_id.in_(
+                    select([Entry.id]).where(Entry.feed_id == feed.id))) \
+                .scalar()
+            if last is not None:
+                db.session.execute(
+                    subscriptions.update()
+                    .where(subscriptions.c.user_id == self.id)
+                    .where(subscriptions.c.feed_id == feed.id)
+                    .values(last_entry_id=last))
+            return
+
+        # Queue up any existing entries that haven't been delivered yet.
+        delivered = select([user_entry.c.entry_id]) \
+            .where(user_entry.c.user_id == self.id)
+        queued = select([outbox.c.entry_id]) \
+            .where(outbox.c.user_id == self.id)
+        entries = select([Entry.id]).where(Entry.feed_id == feed.id) \
+            .where(~Entry.id.in_(delivered)) \
+            .where(~Entry.id.in_(queued))
+        rows = [dict(user_id=self.id, entry_id=i)
+                for i, in db.session.execute(entries)]
+        if len(rows):
+            db.session.execute(outbox.insert(), rows)
+
+    def unsubscribe(self, feed):
+        entries = select([Entry.id]).where(Entry.feed_id == feed.id)
+
+        # The watermark goes away with the subscription so remember it as
+        # the only delivered entry of this feed in user_entry.
+        if not track_history():
+            last = db.session.query(subscriptions.c.last_entry_id) \
+                .filter(subscriptions.c.user_id == self.id) \
+                .filter(subscriptions.c.feed_id == feed.id).scalar()
+            if last is not None:
+                db.session.execute(user_entry.delete()
+                                   .where(user_entry.c.user_id == self.id)
+                                   .where(user_entry.c.entry_id.in_(entries)))
+                db.session.execute(user_entry.insert(),
+                                   [dict(user_id=self.id, entry_id=last)])
+
+        self.feeds.remove(feed)
+        self.subscription_version = (self.subscription_version or 0) + 1
+        db.session.execute(outbox.delete()
+                           .where(outbox.c.user_id == self.id)
+                           .where(outbox.c.entry_id.in_(entries)))
+
+    def get_oauth2_token(self, refresh=False):
+        config = flask.current_app.config
+        margin = config["TOKEN_REFRESH_MARGIN"]
+        store = config["TOKEN_STORE"] == "database"
+        cache = get_token_cache()
+
+        # Try the cached tokens first.
+        now = datetime.utcnow()
+        if not refresh:
+            token = cache.get(self.id)
+            if token is not None:
+                metrics.inc("oauth_tokens", source="cache")
+                return token
+            if (store and self.access_token is not None and
+                    self.access_token_expires is not None):
+                ttl = (self.access_token_expires - now).total_seconds()
+                ttl -= margin
+                if ttl > 0:
+                    cache.set(self.id, self.access_token, ttl=ttl)
+                    metrics.inc("oauth_tokens", source="database")
+                    return self.access_token
+
+        # Get a new access token.
         data = {
             "refresh_token": self.refresh_token,
-            "client_id":
-            flask.current_app.config["GOOGLE_OAUTH2_CLIENT_ID"],
-            "client_secret":
-            flask.current_app.config["GOOGLE_OAUTH2_CLIENT_SECRET"],
+            "client_id": config["GOOGLE_OAUTH2_CLIENT_ID"],
+            "client_secret": config["GOOGLE_OAUTH2_CLIENT_SECRET"],
             "grant_type": "refresh_token",
         }
-        r = requests.post("https://accounts.google.com/o/oauth2/token",
-                          data=data)
-        return r.json().get("access_token")
+        metrics.inc("oauth_tokens", source="refresh")
+        with metrics.timer("oauth", unit=self.id):
+            r = requests.post(config["GOOGLE_TOKEN_URL"], data=data)
+            data = r.json()
+        token = data.get("access_token")
+        if token is None:
+            return None
+
+        # Save it until a little while before it expires.
+        expires_in = int(data.get("expires_in", 3600))
+        cache.set(self.id, token, ttl=max(0, expires_in - margin))
+        if store:
+            self.access_token = token
+            self.access_token_expires = now + timedelta(seconds=expires_in)
+        return token
 
     def get_imap_connection(self):
         # Connect to the IMAP server.
-        connection = imaplib.IMAP4_SSL("imap.gmail.com")
-        s = "user={0}\1auth=Bearer {1}\1\1".format(self.get_email(),
-                                                   self.get_oauth2_token())
-        status, data = connection.authenticate("XOAUTH2", lambda x: s)
+        config = flask.current_app.config
+        if config["IMAP_SSL"]:
+            connection = imaplib.IMAP4_SSL(config["IMAP_HOST"],
+                                           config["IMAP_PORT"])
+        else:
+            connection = imaplib.IMAP4(config["IMAP_HOST"],
+                                       config["IMAP_PORT"])
+        for refresh in (False, True):
+            s = "user={0}\1auth=Bearer {1}\1\1".format(
+                self.get_email(), self.get_oauth2_token(refresh=refresh))
+            try:
+                status, data = connection.authenticate("XOAUTH2",
+                                                       lambda x: s)
+            except imaplib.IMAP4.error:
+                # The cached token might have been revoked so try again
+                # with a fresh one.
+                if refresh:
+                    raise
+                get_token_cache().pop(self.id)
+                continue
+            break
         assert status == "OK"
 
         return connection
 
-    def deliver_entries(self):
+    def deliver_entries(self, lease=None):
+        """
+        Deliver all of the pending entries and return the number of messages
+        that were delivered.
+
+        :param lease: (optional)
+            If uglyd is sharing the users with other workers, a function that
+            renews its lease on this user and returns ``False`` if the lease
+            was lost. It's called before and after each append.
+
+        """
         try:
-            connection = self.get_imap_connection()
+            with metrics.timer("imap_connect", unit=self.id):
+                connection = self.get_imap_connection()
         except AssertionError:
             raise RuntimeError("Couldn't authenticate.")
 
+        # Find all of the entries that are waiting to be delivered.
+        pending = db.session.query(Entry.feed_id, Entry.id)
+        if track_history():
+            pending = pending.join(outbox, outbox.c.entry_id == Entry.id) \
+                .filter(outbox.c.user_id == self.id)
+        else:
+            pending = pending.join(subscriptions,
+                                   subscriptions.c.feed_id == Entry.feed_id) \
+                .filter(subscriptions.c.user_id == self.id) \
+                .filter(Entry.id > func.coalesce(subscriptions.c.last_entry_id,
+                                                 0))
+        pending = pending.order_by(Entry.feed_id, Entry.id).all()
+
+        # Deliver them one feed at a time.
+        known = None
+        if self.mailboxes is not None:
+            known = [mb for mb in self.mailboxes.split("\n") if mb]
+        mailboxes = MailboxCache(connection, known=known)
         count = 0
-        for feed in self.feeds:
-            count += self.deliver_entries_for_feed(feed, connection=connection)
+        for feed_id, rows in groupby(pending, lambda r: r[0]):
+            entries = Entry.query.filter(Entry.id.in_([r[1] for r in rows])) \
+                .order_by(Entry.id).all()
+            count += self.deliver_entries_for_feed(Feed.query.get(feed_id),
+                                                   entries,
+                                                   connection=connection,
+                                                   mailboxes=mailboxes,
+                                                   lease=lease)
+
+        # Remember the mailboxes for next time.
+        if mailboxes.changed:
+            self.mailboxes = "\n".join(sorted(mailboxes.known))
 
         try:
             connection.close()
@@ -167,28 +531,28 @@ class User(db.Model):
             logging.info("No emails to deliver for: {0}"
                          .format(self.get_email()))
 
-    def deliver_entries_for_feed(self, feed, connection):
-        # Find the entries that are waiting to be delivered and return if
-        # there are none.
-        entries = db.session.query(Entry).filter(Entry.feed == feed) \
-            .filter(~Entry.users.contains(self)).all()
+        return count
+
+    def deliver_entries_for_feed(self, feed, entries, connection,
+                                 mailboxes=None, lease=None):
         if not len(entries):
             return 0
+        if mailboxes is None:
+            mailboxes = MailboxCache(connection)
 
-        # Try and create the labels.
+        # Make sure that the labels exist and select the feed's mailbox.
         base = flask.current_app.config["BASE_MAILBOX"]
         mb = "{0}/{1}".format(base, feed.title)
-        connection.create(base)
-        connection.create(mb)
-
-        # Select the mailbox.
-        status, data = connection.select(mb)
+        with metrics.timer("imap_select", unit=self.id):
+            mailboxes.ensure(base)
+            status, data = mailboxes.select(mb)
         if status != "OK":
             logging.warn(data)
             return 0
 
-        # Deliver the messages.
+        # Build the messages.
         email = self.get_email()
+        messages = []
         for entry in entries:
             # Work out the time stamp.
             if entry.updated is not None:
@@ -205,34 +569,143 @@ class User(db.Model):
             msg["Subject"] = u"{0} — {1}".format(feed.title, entry.title)
             msg["Date"] = formatdate(ts)
 
-            # Render the message body as HTML.
-            contents = flask.render_template("message.html", feed=feed,
-                                             entry=entry)
-
-            # Build the plain text extension.
-            part1 = MIMEText(html2text.html2text(contents).encode("utf-8"),
-                             "plain", "utf-8")
-            msg.attach(part1)
-
-            # Build the HTML extension.
-            part2 = MIMEText(contents.encode("utf-8"), "html", "utf-8")
-            msg.attach(part2)
-
-            # Add the message to Gmail.
-            status, [data] = connection.append(mb, None, ts, msg.as_string())
-            if status == "OK":
-                # Add the base label too.
-                uid = re.findall("\[APPENDUID ([0-9]*) ([0-9]*)\]", data)[0][1]
-                connection.uid("COPY", uid, base)
-
-            # Update the user to know that this message has been delivered.
-            self.entries.append(entry)
-
-        # Update the database session.
-        db.session.add(self)
-        db.session.commit()
+            # Attach the (shared) plain text and HTML parts.
+            for part in entry.render():
+                msg.attach(part)
+
+            messages.append((ts, msg.as_string()))
+
+        # Don't send anything if another worker has taken over this user.
+        if lease is not None and not lease():
+            raise RuntimeError("Lost the lease.")
+
+        # Add the messages to Gmail and then add the base label to all of
+        # them at once. In "watermark" mode, nothing is sent after the first
+        # message that fails so that the watermark never has to skip one.
+        config = flask.current_app.config
+        history = track_history()
+        with metrics.timer("imap_append", unit=self.id):
+            statuses, uids = append_messages(
+                connection, mb, messages, batch=config["IMAP_APPEND_BATCH"],
+                stop=not history)
+        with metrics.timer("imap_copy", unit=self.id):
+            status, data = copy_messages(connection, uids, base)
+            if status not in ("OK", None):
+                mailboxes.create(base)
+                copy_messages(connection, uids, base)
+
+        # Don't record anything if another worker took over in the meantime.
+        if lease is not None and not lease():
+            raise RuntimeError("Lost the lease.")
+
+        # Only the messages that made it are marked as delivered.
+        ids = [e.id for e, s in zip(entries, statuses) if s == "OK"]
+        metrics.inc("messages", len(ids))
+        if len(ids) < len(entries):
+            logging.warn("Couldn't append {0} of {1} messages for: {2}"
+                         .format(len(entries) - len(ids), len(entries),
+                                 email))
+
+        # Give up on the ones that the server keeps rejecting.
+        rejected = [e.id for e, s in zip(entries, statuses) if s == "NO"]
+        dropped = []
+        if len(rejected):
+            dropped = self.reject_entries(feed, rejected,
+                                          moved=statuses[0] == "OK")
+        elif not len(ids):
+            return 0
 
-        return len(entries)
+        # The watermark stops just before the first entry that's still
+        # pending.
+        done = set(ids + dropped)
+        watermark = None
+        for e in entries:
+            if e.id not in done:
+                break
+            watermark = e.id
+
+        # Update the user to know that these messages have been delivered.
+        # The watermark is kept up to date in both tracking modes so that
+        # "history" can be switched to "watermark" at any time. The outbox
+        # is only kept in "history" mode so it's filled in again by
+        # ugly.migrations.sync_tracking when switching back.
+        if history and len(ids):
+            db.session.execute(user_entry.insert(),
+                               [dict(user_id=self.id, entry_id=i)
+                                for i in ids])
+            db.session.execute(outbox.delete()
+                               .where(outbox.c.user_id == self.id)
+                               .where(outbox.c.entry_id.in_(ids)))
+        if watermark is not None:
+            values = dict(last_entry_id=watermark)
+            if not len(rejected):
+                values["rejections"] = 0
+            db.session.execute(
+                subscriptions.update()
+                .where(subscriptions.c.user_id == self.id)
+                .where(subscriptions.c.feed_id == feed.id)
+                .where(func.coalesce(subscriptions.c.last_entry_id, 0) <
+                       watermark)
+                .values(**values))
+        with metrics.timer("commit"):
+            db.session.commit()
+
+        return len(ids)
+
+    def reject_entries(self, feed, ids, moved=False):
+        """
+        Count another rejection by the IMAP server of some of the entries of
+        a feed and return the ids of the ones that have now been rejected
+        ``APPEND_MAX_TRIES`` times. Those are given up on and treated as
+        delivered from then on.
+
+        :param feed:
+            The feed that the entries belong to.
+
+        :param ids:
+            The ids of the rejected entries. In "watermark" mode, this can
+            only be the entry just after the watermark.
+
+        :param moved: (optional)
+            In "watermark" mode, did the watermark move up to the rejected
+            entry in this delivery? If so, its count starts again.
+
+        """
+        max_tries = flask.current_app.config["APPEND_MAX_TRIES"]
+        if track_history():
+            queued = and_(outbox.c.user_id == self.id,
+                          outbox.c.entry_id.in_(ids))
+            db.session.execute(outbox.update().where(queued).values(
+                rejections=func.coalesce(outbox.c.rejections, 0) + 1))
+            dropped = []
+            if max_tries is not None:
+                dropped = [i for i, in db.session.execute(
+                    select([outbox.c.entry_id]).where(queued)
+                    .where(outbox.c.rejections >= max_tries))]
+            if len(dropped):
+                db.session.execute(outbox.delete().where(and_(
+                    outbox.c.user_id == self.id,
+                    outbox.c.entry_id.in_(dropped))))
+        else:
+            subscription = and_(subscriptions.c.user_id == self.id,
+                                subscriptions.c.feed_id == feed.id)
+            count = 1
+            if not moved:
+                count += db.session.execute(
+                    select([subscriptions.c.rejections])
+                    .where(subscription)).scalar() or 0
+            dropped = []
+            if max_tries is not None and count >= max_tries:
+                dropped, count = list(ids), 0
+            db.session.execute(subscriptions.update().where(subscription)
+                               .values(rejections=count))
+
+        if len(dropped):
+            logging.error("Gave up on {0} messages from {1} for {2} after "
+                          "{3} tries".format(len(dropped), feed.url,
+                                             self.get_email(), max_tries))
+            metrics.inc("messages_dropped", len(dropped))
+        return dropped
 
 
 class Feed(db.Model):
@@ -249,6 +722,22 @@ class Feed(db.Model):
     etag = Column(String)
     modified = Column(String)
 
+    # Digests of the last fetched body and of its list of entries for the
+    # servers that don't do conditional requests properly.
+    body_digest = Column(String)
+    entries_digest = Column(String)
+
+    # Scheduling. The post interval is a running estimate of the number of
+    # seconds between changes.
+    last_checked = Column(DateTime)
+    last_changed = Column(DateTime)
+    post_interval = Column(Float)
+    next_check_at = Column(DateTime, index=True)
+
+    # The uglyd worker polling this feed and until when (see ugly.leases).
+    lease_owner = Column(String)
+    lease_expires = Column(DateTime)
+
     def __init__(self, url):
         self.url = url
         self.active = True
@@ -256,6 +745,9 @@ class Feed(db.Model):
     def __repr__(self):
         return "<Feed(\"{0}\")>".format(self.url)
 
+    # The attributes that are exposed by the API.
+    fields = ("id", "url", "link", "title")
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -264,8 +756,24 @@ class Feed(db.Model):
             "title": self.title,
         }
 
+    def touch_subscribers(self):
+        """
+        Bump the ``subscription_version`` of every subscriber so that their
+        cached feed lists are invalidated.
+
+        """
+        if self.id is None:
+            return
+        users = User.__table__
+        subscribers = select([subscriptions.c.user_id]) \
+            .where(subscriptions.c.feed_id == self.id)
+        db.session.execute(users.update()
+                           .where(users.c.id.in_(subscribers))
+                           .values(subscription_version=func.coalesce(
+                               users.c.subscription_version, 0) + 1))
+
     def update_info(self):
-        tree = feedparser.parse(self.url)
+        tree = fetch_feed(self.url)
         status = tree.get("status")
         if status == 410:
             logging.info("Dead link at: {0}".format(self.url))
@@ -279,15 +787,68 @@ class Feed(db.Model):
 
         assert self.title is not None
 
-    def update(self, force=False, tries=0):
+    def fetch(self):
+        return fetch_feed(self.url, etag=self.etag, modified=self.modified,
+                          digest=self.body_digest)
+
+    def schedule(self, changed, tree=None):
+        """
+        Decide when this feed should next be polled. Feeds that changed are
+        polled at about twice their observed posting rate and quiet feeds
+        back off geometrically. The delay never drops below the server's
+        caching hints and always stays within the ``POLL_MIN_INTERVAL`` and
+        ``POLL_MAX_INTERVAL`` config options.
+
+        :param changed:
+            Did this poll find new entries?
+
+        :param tree: (optional)
+            The parsed feed, used for the caching hints.
+
+        """
+        config = flask.current_app.config
+        now = datetime.utcnow()
+
+        if changed:
+            if self.last_changed is not None:
+                observed = (now - self.last_changed).total_seconds()
+                if self.post_interval is None:
+                    self.post_interval = observed
+                else:
+                    self.post_interval = 0.5 * (self.post_interval + observed)
+            self.last_changed = now
+            delay = 0.5 * (self.post_interval or 0)
+        elif self.last_checked is not None and self.next_check_at is not None:
+            delay = (self.next_check_at - self.last_checked).total_seconds()
+            delay *= config["POLL_BACKOFF"]
+        else:
+            delay = 0
+
+        hint = None if tree is None else poll_hint(tree)
+        if hint is not None:
+            delay = max(delay, hint)
+        delay = min(max(delay, config["POLL_MIN_INTERVAL"]),
+                    config["POLL_MAX_INTERVAL"])
+
+        self.last_checked = now
+        self.next_check_at = now + timedelta(seconds=delay)
+
+    def update(self, force=False, tries=0, tree=None):
+        """
+        Poll the feed and add any new entries. Returns what happened:
+        ``"skipped"``, ``"error"``, ``"gone"``, ``"not-modified"`` (a 304),
+        ``"unchanged-body"`` or ``"unchanged-entries"`` (the content digests
+        matched) or ``"updated"``.
+
+        """
         # Don't keep hitting dead links.
         if (not force) and (not self.active):
             logging.info("Skipped dead link at: {0}".format(self.url))
-            return
+            return "skipped"
 
-        # Do a conditional fetch and parse.
-        tree = feedparser.parse(self.url, etag=self.etag,
-                                modified=self.modified)
+        # Do a conditional fetch and parse unless the caller already did.
+        if tree is None:
+            tree = self.fetch()
 
         # Deal with the response code.
         status = tree.get("status")
@@ -296,55 +857,128 @@ class Feed(db.Model):
         if status is None:
             logging.warn("No status attribute in returned tree object for"
                          "url: {0}".format(self.url))
-            return
+            self.schedule(False)
+            return "error"
 
         # Return if nothing has changed.
         elif status == 304:
             logging.info("No changes at: {0}".format(self.url))
-            return
+            self.schedule(False, tree)
+            return "not-modified"
 
         # Permanent redirect.
         elif status == 301:
             new_url = tree.get("href", self.url)
             logging.info("Permanent redirect of: {0} -> {1}"
                          .format(self.url, new_url))
-            self.url = new_url
+            if new_url != self.url:
+                self.url = new_url
+                self.touch_subscribers()
 
         # The feed is gone forever.
         elif status == 410:
             logging.info("Dead link at: {0}".format(self.url))
             self.active = False
-            return
+            return "gone"
+
+        # Any other HTTP error. The error page wasn't parsed so the stored
+        # validators and digests are left alone.
+        elif status >= 400:
+            logging.warn("Got a {0} from: {1}".format(status, self.url))
+            self.schedule(False)
+            return "error"
+
+        # The body is byte-for-byte the same as last time so it wasn't even
+        # parsed.
+        if tree.get("unchanged"):
+            logging.info("Unchanged content at: {0}".format(self.url))
+            self.etag = tree.get("etag")
+            self.modified = tree.get("modified")
+            self.schedule(False, tree)
+            return "unchanged-body"
 
         # Get the feed info.
         self.active = True
+        info = (self.title, self.link)
         self.title = tree.feed.get("title", self.title)
         self.link = tree.feed.get("link", self.link)
+        if (self.title, self.link) != info:
+            self.touch_subscribers()
 
         # Something went horribly wrong. Try again?
         if self.title is None:
             logging.warn("No title attribute at: {0}".format(self.url))
             if tries < 10:
-                self.update(force=force, tries=tries+1)
-            else:
-                logging.error("Too many retries on {0}".format(self.url))
-            return
+                return self.update(force=force, tries=tries+1)
+            logging.error("Too many retries on {0}".format(self.url))
+            self.schedule(False)
+            return "error"
 
         # Stop all the downloading.
         self.etag = tree.get("etag")
         self.modified = tree.get("modified")
-
-        # Loop over the entries.
-        for e in tree.entries:
-            # See if the entry already exists.
-            entry = Entry.query.filter(Entry.feed == self) \
-                .filter(Entry.ref == (e.get("id") or e.get("link"))).first()
-            if entry is not None:
+        self.body_digest = tree.get("digest")
+
+        # Skip the ingestion if the list of entries hasn't changed.
+        digest = digest_entries(tree.entries)
+        if digest == self.entries_digest:
+            logging.info("Unchanged entries at: {0}".format(self.url))
+            self.schedule(False, tree)
+            return "unchanged-entries"
+        self.entries_digest = digest
+
+        # Only look at the first few entries of very large feeds.
+        config = flask.current_app.config
+        items = tree.entries
+        if config["FEED_MAX_ITEMS"]:
+            items = items[:config["FEED_MAX_ITEMS"]]
+
+        with metrics.timer("ingest", unit=self.url):
+            entries = self._ingest(items)
+        metrics.inc("entries", len(entries))
+        self.schedule(len(entries) > 0, tree)
+        return "updated"
+
+    def _ingest(self, items):
+        # Find the entries that we already have with a single query.
+        config = flask.current_app.config
+        refs = [e.get("id") or e.get("link") for e in items]
+        known = set()
+        if self.id is not None and any(refs):
+            known = set(r for r, in db.session.query(Entry.ref)
+                        .filter(Entry.feed_id == self.id)
+                        .filter(Entry.ref.in_([r for r in refs if r])))
+
+        # Create the new entries and save them all at once. Feeds list their
+        # newest entries first so stop after a run of ones that we've
+        # already seen.
+        entries, seen = [], 0
+        for e, ref in zip(items, refs):
+            if ref is None:
+                logging.warn("Entry without id or link at: {0}"
+                             .format(self.url))
                 continue
-
-            # Create a new entry and save.
-            entry = Entry(self, e)
-            self.entries.append(entry)
+            if ref in known:
+                seen += 1
+                if config["FEED_KNOWN_STOP"] and \
+                        seen >= config["FEED_KNOWN_STOP"]:
+                    break
+                continue
+            seen = 0
+            known.add(ref)
+            entries.append(Entry(self, e))
+        db.session.add_all(entries)
+
+        # Queue the new entries for delivery to all of the subscribers.
+        if len(entries) and track_history():
+            db.session.flush()
+            users = db.session.query(subscriptions.c.user_id) \
+                .filter(subscriptions.c.feed_id == self.id).all()
+            rows = [dict(user_id=u, entry_id=entry.id)
+                    for u, in users for entry in entries]
+            if len(rows):
+                db.session.execute(outbox.insert(), rows)
+        return entries
 
 
 class Entry(db.Model):
@@ -356,6 +990,8 @@ class Entry(db.Model):
     ref = Column(String)
     link = Column(String)
     body = Column(String)
+    content = Column(Text)
+    content_version = Column(Integer)
     title = Column(String)
     author = Column(String)
     published = Column(DateTime)
@@ -376,6 +1012,7 @@ class Entry(db.Model):
         except:
             logging.warn("Content couldn't be parsed.\n{0}".format(self.link))
             self.body = entry.get("description")
+        self.process()
 
         self.title = entry.get("title")
         self.author = entry.get("author")
@@ -390,8 +1027,95 @@ class Entry(db.Model):
     def __repr__(self):
         return "<Entry({1}, \"{0}\")>".format(self.ref, repr(self.feed))
 
+    def render(self):
+        """
+        Render the plain text and HTML parts of the email for this entry.
+        The parts are cached by entry id and ``MESSAGE_TEMPLATE_VERSION`` so
+        that each entry is only rendered once no matter how many users it is
+        delivered to. The parts must not be modified.
+
+        """
+        key = (self.id, flask.current_app.config["MESSAGE_TEMPLATE_VERSION"])
+        cache = get_render_cache()
+        parts = cache.get(key)
+        if parts is not None:
+            metrics.inc("renders", cache="hit")
+            return parts
+        metrics.inc("renders", cache="miss")
+
+        with metrics.timer("render"):
+            # Render the message body as HTML.
+            contents = flask.render_template("message.html", feed=self.feed,
+                                             entry=self)
+
+            # Build the plain text and HTML extensions.
+            parts = (
+                MIMEText(html2text.html2text(contents).encode("utf-8"),
+                         "plain", "utf-8"),
+                MIMEText(contents.encode("utf-8"), "html", "utf-8"),
+            )
+        if self.id is not None:
+            cache.set(key, parts)
+        return parts
+
+    def process(self):
+        """
+        Process the body with :func:`process_body` and store the result on
+        this entry along with the current ``BODY_VERSION``.
+
+        """
+        self.content = process_body(self.body)
+        self.content_version = BODY_VERSION
+
     def get_body(self):
-        soup = BeautifulSoup(self.body)
-        for img in soup.find_all("img"):
-            img["style"] = "max-width:100%;"
-        return soup.decode("utf-8")
+        """
+        Get the processed body. This is computed when the entry is ingested
+        and only needs to be done again (and saved with the entry) when
+        ``BODY_VERSION`` changes.
+
+        """
+        if self.content is None or self.content_version != BODY_VERSION:
+            self.process()
+        return self.content
+
+
+# Make sure that concurrent updates can't create duplicate entries.
+Index("ix_entries_feed_id_ref", Entry.feed_id, Entry.ref, unique=True)
+
+# Find the entries above a delivery watermark with a range scan.
+Index("ix_entries_feed_id_id", Entry.feed_id, Entry.id)
+
+
+class Job(db.Model):
+    """
+    A background job (see :mod:`ugly.jobs`). The arguments and the result
+    are stored as JSON.
+
+    """
+
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    kind = Column(String)
+    args = Column(Text)
+    status = Column(String, index=True)
+    message = Column(String)
+    result = Column(Text)
+    created = Column(DateTime)
+    updated = Column(DateTime)
+
+
+class Discovery(db.Model):
+    """
+    The cached result of looking for the feeds at a URL (see
+    :mod:`ugly.discovery`). The feed URLs are newline separated and an
+    empty list means that nothing was found.
+
+    """
+
+    __tablename__ = "discoveries"
+
+    key = Column(String, primary_key=True)
+    urls = Column(Text)
+    expires = Column(DateTime, index=True)
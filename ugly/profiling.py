@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Profile uglyd one unit of work (the update of a feed or the delivery to a
+user) at a time to find out why some of them are so slow. Each unit runs
+under its own :class:`cProfile.Profile` and, if it took longer than the
+threshold, its profile (and optionally the SQL that it issued) is written to
+the output directory. The profiles of all of the units are also added up by
+kind and written out by :func:`Profiler.write`. The ``.prof`` files can be
+read with :mod:`pstats` or any of the usual viewers.
+
+"""
+
+__all__ = ["Profiler"]
+
+import os
+import re
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+
+_unsafe = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+class Profiler(object):
+    """
+    Profile units of work and write out the slow ones.
+
+    :param directory:
+        The directory to write the profiles to.
+
+    :param threshold: (optional)
+        Only keep the profiles of the units that took at least this many
+        milliseconds. All of them are included in the aggregate.
+
+    :param engine: (optional)
+        If given, the SQL statements executed on this engine during each
+        unit are recorded and written next to its profile.
+
+    """
+
+    def __init__(self, directory, threshold=1000, engine=None):
+        self.directory = directory
+        self.threshold = threshold
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reset()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if engine is not None:
+            event.listen(engine, "before_cursor_execute", self._before)
+            event.listen(engine, "after_cursor_execute", self._after)
+
+    def reset(self):
+        """
+        Forget the aggregated profiles and the list of slow units.
+
+        """
+        with self.lock:
+            self.stats = {}
+            self.slow = []
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if getattr(self.local, "queries", None) is not None:
+            self.local.strt = time.time()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        queries = getattr(self.local, "queries", None)
+        if queries is not None:
+            queries.append((time.time() - self.local.strt, statement,
+                            parameters))
+
+    @contextmanager
+    def profile(self, kind, unit):
+        """
+        Profile the body of a ``with`` statement as one unit of work. Only
+        the calling thread is profiled.
+
+        :param kind:
+            The kind of work (like ``"update"`` or ``"deliver"``).
+
+        :param unit:
+            The id of the feed, user, etc. that the work is for.
+
+        """
+        profile = cProfile.Profile()
+        self.local.queries = []
+        strt = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            dt = time.time() - strt
+            queries, self.local.queries = self.local.queries, None
+            self._finish(kind, unit, profile, dt, queries)
+
+    def _finish(self, kind, unit, profile, dt, queries):
+        profile.create_stats()
+        with self.lock:
+            if kind in self.stats:
+                self.stats[kind].add(profile)
+            else:
+                self.stats[kind] = pstats.Stats(profile)
+        if dt * 1000 < self.threshold:
+            return
+
+        name = "{0}-{1}".format(kind, _unsafe.sub("_", unicode(unit)))
+        path = os.path.join(self.directory, name)
+        try:
+            profile.dump_stats(path + ".prof")
+            if len(queries):
+                _write_queries(path + ".sql", queries)
+        except (IOError, OSError):
+            logging.exception("Couldn't write the profile of {0} {1}"
+                              .format(kind, unit))
+            return
+        with self.lock:
+            self.slow.append((dt, kind, unit, len(queries),
+                              sum(q[0] for q in queries)))
+
+    def write(self):
+        """
+        Write the aggregated profile for each kind of work to
+        ``<kind>.prof`` and a list of the slow units, slowest first, to
+        ``slow.txt``.
+
+        """
+        with self.lock:
+            for kind, stats in self.stats.items():
+                stats.dump_stats(os.path.join(self.directory,
+                                              kind + ".prof"))
+            with open(os.path.join(self.directory, "slow.txt"), "w") as f:
+                f.write("# seconds kind unit queries sql_seconds\n")
+                for row in sorted(self.slow, reverse=True):
+                    f.write(u"{0:.3f} {1} {2} {3} {4:.3f}\n".format(*row)
+                            .encode("utf-8"))
+
+
+def _write_queries(path, queries):
+    with open(path, "w") as f:
+        f.write("-- {0} statements in {1:.3f} seconds\n\n".format(
+            len(queries), sum(q[0] for q in queries)))
+        for dt, statement, parameters in queries:
+            parameters = repr(parameters)
+            if len(parameters) > 500:
+                parameters = parameters[:500] + "..."
+            f.write(u"-- {0:.2f} ms {1}\n{2};\n\n".format(
+                dt * 1000, parameters, statement).encode("utf-8"))
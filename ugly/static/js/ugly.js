@@ -36,12 +36,35 @@
         data: {url: url},
         success: function (data) {
           display_status(data.message);
-          this_.feeds_view.model.add(data.feed);
+          this_.wait_for_job(data.url);
         },
         error: function (xhr, errorType, error) {
           display_error(eval("("+xhr.response+")").message);
+          this_.add_feed_view.enable();
+        }
+      });
+    },
+    wait_for_job: function (url) {
+      var this_ = this;
+      $.ajax({
+        url: url,
+        type: "GET",
+        dataType: "json",
+        success: function (data) {
+          if (data.status == "done") {
+            display_status(data.message);
+            this_.feeds_view.model.add(data.feed);
+          } else if (data.status == "failed") {
+            display_error(data.message);
+          } else {
+            if (data.message) display_status(data.message);
+            setTimeout(function () { this_.wait_for_job(url); }, 1000);
+            return;
+          }
+          this_.add_feed_view.enable();
         },
-        complete: function () {
+        error: function (xhr, errorType, error) {
+          display_error(eval("("+xhr.response+")").message);
           this_.add_feed_view.enable();
         }
       });
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the external services that uglyd talks to so that it
+can be exercised offline. For example, to use a fake Google token endpoint::
+
+    server = TokenServer(expires_in=60).start()
+    app.config["GOOGLE_TOKEN_URL"] = server.url
+    ...
+    server.stop()
+
+The feed server and the IMAP server are used the same way. See
+``bench/pipeline.py`` for all three together.
+
+"""
+
+__all__ = ["TokenServer", "FeedServer", "IMAPServer"]
+
+import re
+import json
+import gzip
+import time
+import base64
+import threading
+from StringIO import StringIO
+from urlparse import parse_qs
+from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _TCPServer(ThreadingMixIn, TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubServer(object):
+    """
+    The base class for the stand-in servers. Each one listens on a local
+    port (picked by the OS by default) and serves from a daemon thread.
+
+    :param handler:
+        The :class:`SocketServer.BaseRequestHandler` subclass used to handle
+        the requests. It can reach this object as ``self.server.stub``.
+
+    :param host: (optional)
+        The interface to listen on.
+
+    :param port: (optional)
+        The port to listen on.
+
+    """
+
+    server_class = _HTTPServer
+
+    def __init__(self, handler, host="127.0.0.1", port=0):
+        self.server = self.server_class((host, port), handler)
+        self.server.stub = self
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(self.host, self.port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _TokenHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get("Content-Length", 0))
+        data = parse_qs(self.rfile.read(length))
+        with stub.lock:
+            stub.requests += 1
+            count = stub.requests
+
+        if data.get("grant_type") != ["refresh_token"]:
+            return self.respond(400, {"error": "unsupported_grant_type"})
+        if not data.get("refresh_token"):
+            return self.respond(400, {"error": "invalid_grant"})
+        return self.respond(200, {
+            "access_token": "stub-token-{0}".format(count),
+            "token_type": "Bearer",
+            "expires_in": stub.expires_in,
+        })
+
+    def respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TokenServer(StubServer):
+    """
+    A stand-in for Google's OAuth2 token endpoint. It hands out a new access
+    token for every refresh token grant and counts the requests it serves.
+
+    :param expires_in: (optional)
+        The lifetime in seconds reported for each access token.
+
+    """
+
+    def __init__(self, expires_in=3600, **kwargs):
+        super(TokenServer, self).__init__(_TokenHandler, **kwargs)
+        self.expires_in = expires_in
+        self.requests = 0
+
+
+class _FeedHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        stub = self.server.stub
+        m = re.match(r"^/feed/([0-9]+)\.xml$", self.path)
+        if m is None or int(m.group(1)) >= stub.feeds:
+            return self.respond(404, "")
+        if stub.latency:
+            time.sleep(stub.latency)
+        n = int(m.group(1))
+
+        with stub.lock:
+            stub.requests += 1
+            count = stub.requests
+            generation = stub.generation
+
+        etag = None
+        if stub.etag == "strong":
+            etag = '"{0}-{1}"'.format(n, generation)
+            if self.headers.get("If-None-Match") == etag:
+                with stub.lock:
+                    stub.not_modified += 1
+                return self.respond(304, "", etag=etag)
+        elif stub.etag == "changing":
+            etag = '"{0}-{1}"'.format(n, count)
+
+        body = stub.render(n, generation)
+        encoding = None
+        if stub.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode="w")
+            f.write(body)
+            f.close()
+            body, encoding = buf.getvalue(), "gzip"
+        with stub.lock:
+            stub.bytes += len(body)
+        self.respond(200, body, etag=etag, encoding=encoding)
+
+    def respond(self, status, body, etag=None, encoding=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FeedServer(StubServer):
+    """
+    Serve a set of generated RSS feeds at ``/feed/<n>.xml``. Each feed lists
+    its ``entries`` newest entries and :func:`publish` adds new ones to all
+    of the feeds.
+
+    :param feeds: (optional)
+        The number of feeds.
+
+    :param entries: (optional)
+        The number of entries in each feed.
+
+    :param etag: (optional)
+        How the server uses ``ETag`` headers. With ``"strong"`` (the
+        default), each version of a feed has its own ``ETag`` and the
+        server answers conditional requests with a ``304``. With
+        ``"changing"``, the ``ETag`` changes on every request even though
+        the body doesn't. With ``"none"``, there are no ``ETag`` headers.
+
+    :param latency: (optional)
+        The number of seconds to wait before each response.
+
+    :param entry_size: (optional)
+        The approximate size in bytes of each entry's body.
+
+    :param gzip: (optional)
+        Compress the responses if the client asks for it.
+
+    """
+
+    def __init__(self, feeds=1000, entries=20, etag="strong", latency=0,
+                 entry_size=500, gzip=True, **kwargs):
+        super(FeedServer, self).__init__(_FeedHandler, **kwargs)
+        if etag not in ("strong", "changing", "none"):
+            raise ValueError("Unknown ETag mode: {0}".format(etag))
+        self.feeds = feeds
+        self.entries = entries
+        self.etag = etag
+        self.latency = latency
+        self.entry_size = entry_size
+        self.gzip = gzip
+        self.generation = 0
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes = 0
+
+    def feed_url(self, n):
+        return "{0}/feed/{1}.xml".format(self.url, n)
+
+    def publish(self, count=1):
+        """
+        Add ``count`` new entries to every feed.
+
+        """
+        with self.lock:
+            self.generation += count
+
+    def render(self, n, generation):
+        padding = "&lt;p&gt;{0}&lt;/p&gt;".format("x" * self.entry_size)
+        items = "".join(
+            "<item><title>Entry {1} of feed {0}</title>"
+            "<guid>feed-{0}-entry-{1}</guid>"
+            "<link>http://example.com/{0}/{1}</link>"
+            "<description>{2}</description></item>".format(n, i, padding)
+            for i in range(generation + self.entries - 1, generation - 1, -1))
+        return ("<?xml version=\"1.0\"?><rss version=\"2.0\"><channel>"
+                "<title>Feed {0}</title><link>http://example.com/{0}</link>"
+                "{1}</channel></rss>").format(n, items)
+
+
+def _astring(s):
+    # Split an IMAP astring (quoted or not) off the front of a line.
+    s = s.lstrip(" ")
+    if s.startswith("\""):
+        m = re.match(r'"((?:[^"\\]|\\.)*)"', s)
+        return re.sub(r'\\(.)', r'\1', m.group(1)), s[m.end():]
+    value, _, rest = s.partition(" ")
+    return value, " " + rest if rest else ""
+
+
+class _IMAPHandler(StreamRequestHandler):
+
+    def handle(self):
+        stub = self.server.stub
+        self.user = None
+        self.selected = None
+        self.send("* OK [CAPABILITY {0}] Stub IMAP server ready"
+                  .format(stub.capability))
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if stub.latency:
+                time.sleep(stub.latency)
+            with stub.lock:
+                stub.commands[command] = stub.commands.get(command, 0) + 1
+
+            handler = getattr(self, "do_" + command, None)
+            if handler is None:
+                self.send("{0} BAD Unknown command".format(tag))
+            elif command != "AUTHENTICATE" and command not in (
+                    "CAPABILITY", "LOGOUT", "NOOP") and self.user is None:
+                self.send("{0} NO Not authenticated".format(tag))
+            elif handler(tag, args) is False:
+                return
+
+    def send(self, line):
+        self.wfile.write(line + "\r\n")
+
+    def mailboxes(self):
+        return self.server.stub.mailboxes.setdefault(self.user,
+                                                     set(["INBOX"]))
+
+    def do_CAPABILITY(self, tag, args):
+        self.send("* CAPABILITY {0}".format(self.server.stub.capability))
+        self.send("{0} OK CAPABILITY completed".format(tag))
+
+    def do_NOOP(self, tag, args):
+        self.send("{0} OK NOOP completed".format(tag))
+
+    def do_LOGOUT(self, tag, args):
+        self.send("* BYE Logging out")
+        self.send("{0} OK LOGOUT completed".format(tag))
+        return False
+
+    def do_AUTHENTICATE(self, tag, args):
+        if args.upper() != "XOAUTH2":
+            self.send("{0} NO Unsupported mechanism".format(tag))
+            return
+        self.send("+ ")
+        try:
+            fields = dict(f.split("=", 1) for f in base64.b64decode(
+                self.rfile.readline().strip()).split("\1") if f)
+        except (TypeError, ValueError):
+            fields = {}
+        if not fields.get("user") or \
+                not fields.get("auth", "").startswith("Bearer "):
+            self.send("{0} NO [AUTHENTICATIONFAILED] Invalid credentials"
+                      .format(tag))
+            return
+        self.user = fields["user"]
+        self.send("{0} OK Authenticated".format(tag))
+
+    def do_LIST(self, tag, args):
+        with self.server.stub.lock:
+            names = sorted(self.mailboxes())
+        for name in names:
+            self.send('* LIST (\\HasNoChildren) "/" "{0}"'
+                      .format(name.replace("\\", "\\\\").replace('"', '\\"')))
+        self.send("{0} OK LIST completed".format(tag))
+
+    def do_CREATE(self, tag, args):
+        name, _ = _astring(args)
+        with self.server.stub.lock:
+            self.mailboxes().add(name)
+        self.send("{0} OK CREATE completed".format(tag))
+
+    def do_SELECT(self, tag, args):
+        name, _ = _astring(args)
+        with self.server.stub.lock:
+            exists = name in self.mailboxes()
+        if not exists:
+            self.send("{0} NO Mailbox doesn't exist".format(tag))
+            return
+        self.selected = name
+        self.send("* 0 EXISTS")
+        self.send("* OK [UIDVALIDITY 1] UIDs valid")
+        self.send("{0} OK [READ-WRITE] SELECT completed".format(tag))
+
+    def do_CLOSE(self, tag, args):
+        self.selected = None
+        self.send("{0} OK CLOSE completed".format(tag))
+
+    def do_APPEND(self, tag, args):
+        stub = self.server.stub
+        name, line = _astring(args)
+
+        # Read all of the literals (more than one with MULTIAPPEND).
+        messages = []
+        while True:
+            m = re.search(r"\{([0-9]+)(\+?)\}$", line)
+            if m is None:
+                break
+            if not m.group(2):
+                self.send("+ Ready for literal data")
+            messages.append(self.rfile.read(int(m.group(1))))
+            line = self.rfile.readline().rstrip("\r\n")
+        count = len(messages)
+
+        # The whole command fails if any of the messages is rejected.
+        if stub.reject is not None and any(map(stub.reject, messages)):
+            with stub.lock:
+                stub.rejected += 1
+            self.send("{0} NO Message rejected".format(tag))
+            return
+
+        with stub.lock:
+            if name not in self.mailboxes():
+                self.send("{0} NO [TRYCREATE] Mailbox doesn't exist"
+                          .format(tag))
+                return
+            key = (self.user, name)
+            first = stub.uids.get(key, 0) + 1
+            stub.uids[key] = first + count - 1
+            stub.messages += count
+        uids = str(first) if count == 1 else "{0}:{1}".format(
+            first, first + count - 1)
+        self.send("{0} OK [APPENDUID 1 {1}] APPEND completed"
+                  .format(tag, uids))
+
+    def do_UID(self, tag, args):
+        stub = self.server.stub
+        command, _, args = args.partition(" ")
+        if command.upper() != "COPY" or self.selected is None:
+            self.send("{0} BAD Only UID COPY is supported".format(tag))
+            return
+        uid_set, rest = args.split(" ", 1)
+        name, _ = _astring(rest)
+        count = 0
+        for part in uid_set.split(","):
+            a, _, b = part.partition(":")
+            count += abs(int(b or a) - int(a)) + 1
+        with stub.lock:
+            if name not in self.mailboxes():
+                self.send("{0} NO [TRYCREATE] Mailbox doesn't exist"
+                          .format(tag))
+                return
+            stub.copies += count
+        self.send("{0} OK COPY completed".format(tag))
+
+
+class IMAPServer(StubServer):
+    """
+    A stand-in for Gmail's IMAP server. It accepts any ``XOAUTH2`` bearer
+    token and supports just enough of IMAP4rev1 for the deliveries:
+    ``CAPABILITY``, ``LIST``, ``CREATE``, ``SELECT``, ``APPEND`` (with
+    ``UIDPLUS``, ``LITERAL+`` and ``MULTIAPPEND`` by default) and ``UID
+    COPY``. Messages are counted and then thrown away.
+
+    :param capabilities: (optional)
+        The optional extensions to advertise.
+
+    :param latency: (optional)
+        The number of seconds to wait before handling each command.
+
+    :param reject: (optional)
+        A function that's called with the text of each appended message and
+        returns ``True`` if the ``APPEND`` should fail with a ``NO``.
+
+    """
+
+    server_class = _TCPServer
+
+    def __init__(self, capabilities=("UIDPLUS", "LITERAL+", "MULTIAPPEND"),
+                 latency=0, reject=None, **kwargs):
+        super(IMAPServer, self).__init__(_IMAPHandler, **kwargs)
+        self.capability = " ".join(("IMAP4rev1", "AUTH=XOAUTH2") +
+                                   tuple(capabilities))
+        self.latency = latency
+        self.reject = reject
+        self.rejected = 0
+        self.mailboxes = {}
+        self.uids = {}
+        self.commands = {}
+        self.messages = 0
+        self.copies = 0
+
+    @property
+    def url(self):
+        return "imap://{0}:{1}".format(self.host, self.port)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function, absolute_import
+
+__all__ = ["imap_unordered"]
+
+import sys
+import threading
+from Queue import Queue
+from collections import OrderedDict, deque
+
+
+def imap_unordered(func, items, workers=8, key=None, per_key=None):
+    """
+    Apply ``func`` to each element of ``items`` on a bounded pool of worker
+    threads and yield the results in the order that they finish. The results
+    are consumed on the calling thread so anything that isn't thread safe
+    (the database session, for example) should happen there.
+
+    :param func:
+        The function to apply. It should only do thread safe work.
+
+    :param items:
+        An iterable of arguments for ``func``.
+
+    :param workers: (optional)
+        The maximum number of calls running at once.
+
+    :param key: (optional)
+        A function mapping an item to a group (a hostname, for example).
+
+    :param per_key: (optional)
+        The maximum number of calls running at once for any single group.
+
+    Yields ``(item, result, exc_info)`` tuples where ``exc_info`` is ``None``
+    on success and the :func:`sys.exc_info` tuple if ``func`` raised. The
+    workers don't start on a new item while ``workers`` results are waiting
+    to be consumed.
+
+    """
+    if key is None:
+        key = lambda item: None
+    if per_key is None or per_key <= 0:
+        per_key = workers
+
+    # Group the pending items by key. The groups are served round-robin so
+    # that one slow host with many feeds can't starve the others.
+    pending = OrderedDict()
+    count = 0
+    for item in items:
+        pending.setdefault(key(item), deque()).append(item)
+        count += 1
+    if not count:
+        return
+
+    active = dict((k, 0) for k in pending)
+    cond = threading.Condition()
+    nthreads = max(1, min(workers, count))
+    done = object()
+
+    # Only a few results can be waiting at once so that the workers wait
+    # for a slow consumer instead of piling up results in memory.
+    results = Queue(maxsize=nthreads)
+
+    def next_job():
+        with cond:
+            while pending:
+                for k in list(pending):
+                    if active[k] >= per_key:
+                        continue
+                    queue = pending.pop(k)
+                    item = queue.popleft()
+                    if len(queue):
+                        pending[k] = queue
+                    active[k] += 1
+                    return k, item
+                cond.wait()
+        return None
+
+    def run():
+        while True:
+            job = next_job()
+            if job is None:
+                results.put(done)
+                return
+            k, item = job
+            try:
+                results.put((item, func(item), None))
+            except:
+                results.put((item, None, sys.exc_info()))
+            finally:
+                with cond:
+                    active[k] -= 1
+                    cond.notify_all()
+
+    for i in range(nthreads):
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    finished = 0
+    while finished < nthreads:
+        result = results.get()
+        if result is done:
+            finished += 1
+            continue
+        yield result